@@ -0,0 +1,427 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+from telebot import apihelper
+
+import blacklist
+import database
+import enrichment
+import fleet
+import metrics
+import outbox
+import police
+import utils
+
+try:
+	import aiohttp
+	from yarl import URL
+except ImportError:
+	aiohttp = None
+
+# ===== НАСТРОЙКИ ASYNCIO-РЕЖИМА =====
+ASYNC_WD_CONCURRENCY = int(os.getenv('ASYNC_WD_CONCURRENCY', '2'))				# Одновременных запросов к WD
+ASYNC_POLICE_CONCURRENCY = int(os.getenv('ASYNC_POLICE_CONCURRENCY', '3'))		# Одновременных запросов к baza-gai.com.ua
+ASYNC_TELEGRAM_CONCURRENCY = int(os.getenv('ASYNC_TELEGRAM_CONCURRENCY', '5'))	# Одновременных отправок в Telegram
+TELEGRAM_API_URL = 'https://api.telegram.org/bot{0}/{1}'
+
+# Brotli у aiohttp может отсутствовать, поэтому br не запрашиваем
+HEADERS = {key: value for key, value in utils.CHROME_HEADERS.items() if key != 'Accept-Encoding'}
+
+
+def session_cookies(session):
+	"""Куки requests-сессии WD {имя: значение} (их обновляет синхронный логин)"""
+	return {cookie.name: cookie.value for cookie in session.cookies}
+
+
+class Pipeline:
+	"""Синхронные шаги цикла из main.py, которые asyncio-режим использует как есть"""
+
+	def __init__(self, taxis, servers, build_update, commit_update, get_fleet, find_hits, fetch_timeout, fetch_workers, get_stats=None,
+			find_near_misses=None, driver_index=None, report_drivers=None):
+		self.taxis = taxis
+		self.servers = servers
+		self.build_update = build_update		# (blacklist.BlacklistPages, full_scan) -> BlacklistUpdate | None
+		self.commit_update = commit_update		# (update) -> None
+		self.get_fleet = get_fleet				# (taxi, plates) -> (taxi_name, chat_id, cars)
+		self.find_hits = find_hits				# (taxi, cars, black_list, plate_index) -> [carnum]
+		self.get_stats = get_stats				# (session, hits, taxi_name) -> {carnum: stats}
+		self.find_near_misses = find_near_misses			# (taxi, cars, black_list, plate_index) -> [(carnum, fleet_plate)]
+		self.driver_index = driver_index					# () -> drivers.DriverIndex | None
+		self.report_drivers = report_drivers				# (driver_index, black_list) -> None
+		self.fetch_timeout = fetch_timeout
+		self.fetch_workers = fetch_workers
+
+
+class AsyncOutboxDispatcher(outbox.OutboxState):
+	"""Рассылка outbox через Bot API на aiohttp: разные чаты - параллельно"""
+
+	def __init__(self, engine, token, on_error=None):
+		super().__init__(engine.db, on_error)
+		self.engine = engine
+		self.token = token
+		self.wakeup = None
+
+	def notify(self):
+		"""Можно вызывать из любого потока"""
+		self.engine.loop.call_soon_threadsafe(self.wakeup.set)
+
+	async def run(self):
+		self.wakeup = asyncio.Event()
+		logger.info('Async outbox dispatcher started')
+		while True:
+			try:
+				self.wakeup.clear()
+				delay = await self.dispatch()
+			except asyncio.CancelledError:
+				raise
+			except Exception as EX:
+				logger.exception(f'Outbox dispatcher error: {EX}')
+				delay = outbox.OUTBOX_RETRY_BASE
+			try:
+				await asyncio.wait_for(self.wakeup.wait(), delay)
+			except asyncio.TimeoutError:
+				pass
+
+	async def dispatch(self):
+		delay = outbox.OUTBOX_IDLE_WAIT
+		sends = []
+		in_batch = set()
+		waiting = set()
+		messages = await self.engine.blocking(self.db.get_due_messages, outbox.OUTBOX_BATCH)
+		for message_id, chat_id, text, attempts in messages:
+			# В один чат - по одному сообщению за проход, чтобы сохранить порядок
+			if chat_id in in_batch:
+				waiting.add(chat_id)
+				continue
+			chat_delay = self.chat_delay(chat_id)
+			if chat_delay > 0:
+				delay = min(delay, chat_delay)
+				continue
+			in_batch.add(chat_id)
+			sends.append(self.send(message_id, chat_id, text, attempts, self.reserve_global()))
+		await asyncio.gather(*sends)
+		# Следующее сообщение в чат, куда только что отправили, - после его паузы
+		for chat_id in waiting:
+			delay = min(delay, self.chat_delay(chat_id))
+		return await self.engine.blocking(self.next_delay, delay, len(messages) >= outbox.OUTBOX_BATCH)
+
+	async def send(self, message_id, chat_id, text, attempts, wait_time):
+		await asyncio.sleep(wait_time)
+		url = (apihelper.API_URL or TELEGRAM_API_URL).format(self.token, 'sendMessage')
+		async with self.engine.limits['telegram']:
+			started = self.engine.loop.time()
+			try:
+				async with self.engine.http.post(url, json={'chat_id': chat_id, 'text': text}) as response:
+					payload = await response.json(content_type=None)
+					metrics.observe_request(url, response.status, self.engine.loop.time() - started)
+			except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as EX:
+				metrics.observe_request(url, None, self.engine.loop.time() - started)
+				await self.engine.blocking(self.on_failure, message_id, chat_id, text, attempts, EX)
+				return
+		if payload.get('ok'):
+			await self.engine.blocking(self.on_success, message_id, chat_id)
+			return
+		error = f"Error code: {payload.get('error_code')}. Description: {payload.get('description')}"
+		retry_after = None
+		if payload.get('error_code') == 429:
+			retry_after = float((payload.get('parameters') or {}).get('retry_after', outbox.TELEGRAM_CHAT_INTERVAL))
+		await self.engine.blocking(self.on_failure, message_id, chat_id, text, attempts, error, retry_after)
+
+
+class AsyncEngine:
+	"""Цикл проверки на asyncio.
+
+	Event loop работает в отдельном потоке весь срок жизни процесса, планировщик
+	отдаёт ему циклы через run_cycle(). WD, baza-gai.com.ua и Telegram
+	опрашиваются через aiohttp, запросы к Firebird идут в пуле потоков, а
+	количество одновременных запросов к каждому адресату ограничено семафорами.
+	Все такси и все их находки обрабатываются одновременно. Всё, что блокирует
+	(SQLite, разбор страниц, поиск совпадений), выполняется через blocking(),
+	чтобы event loop не останавливался.
+	"""
+
+	def __init__(self, db, token, pipeline, on_error=None):
+		if aiohttp is None:
+			raise RuntimeError('ENGINE=asyncio requires aiohttp (pip install aiohttp)')
+		self.db = db
+		self.pipeline = pipeline
+		self.on_error = on_error
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self.loop.run_forever, name='asyncio', daemon=True)
+		self.executor = ThreadPoolExecutor(max_workers=pipeline.fetch_workers, thread_name_prefix='fetch')
+		self.outbox = AsyncOutboxDispatcher(self, token, on_error)
+		self.http = None
+		self.limits = None
+		self.outbox_task = None
+		self.police_tasks = {}			# номер -> задача запроса к baza-gai, которая уже идёт
+
+	def start(self):
+		self.thread.start()
+		asyncio.run_coroutine_threadsafe(self.startup(), self.loop).result()
+		logger.info('Asyncio engine started')
+
+	async def startup(self):
+		self.http = aiohttp.ClientSession(
+			# unsafe - WD может быть указан IP-адресом
+			cookie_jar=aiohttp.CookieJar(unsafe=True),
+			timeout=aiohttp.ClientTimeout(total=utils.REQUEST_TIMEOUT),
+		)
+		self.limits = {
+			'wd': asyncio.Semaphore(ASYNC_WD_CONCURRENCY),
+			'police': asyncio.Semaphore(ASYNC_POLICE_CONCURRENCY),
+			'telegram': asyncio.Semaphore(ASYNC_TELEGRAM_CONCURRENCY),
+		}
+		self.outbox_task = asyncio.create_task(self.outbox.run())
+
+	def stop(self):
+		asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.executor.shutdown(wait=False, cancel_futures=True)
+
+	async def shutdown(self):
+		self.outbox_task.cancel()
+		await self.http.close()
+
+	async def blocking(self, func, *args, executor=None):
+		"""Синхронный шаг в пуле потоков с контекстом вызывающей задачи (taxi в логах, span Sentry)"""
+		context = contextvars.copy_context()
+		return await self.loop.run_in_executor(executor, functools.partial(context.run, func, *args))
+
+	def run_cycle(self, session, full_scan=False):
+		"""Синхронная обёртка для планировщика"""
+		return asyncio.run_coroutine_threadsafe(self.cycle(session, full_scan), self.loop).result()
+
+	async def cycle(self, session, full_scan):
+		with metrics.stage('blacklist_download'):
+			pages = await self.download_black_list(session)
+		if pages is None:
+			return
+		update = await self.blocking(self.pipeline.build_update, pages, full_scan)
+		if update is None:
+			return
+		to_check = update.to_check()
+		if to_check:
+			logger.info(f'🔎 Checking {len(to_check)} blocked cars across {len(self.pipeline.taxis)} taxis (asyncio)')
+			plates = list(to_check)
+			plate_index = await self.blocking(fleet.PlateIndex, to_check)
+			driver_index = self.pipeline.driver_index() if self.pipeline.driver_index else None
+			results = await asyncio.gather(*(self.process_taxi(session, taxi, to_check, plates, plate_index, driver_index) for taxi in self.pipeline.taxis))
+			if driver_index is not None:
+				await self.blocking(self.pipeline.report_drivers, driver_index, update.black_list)
+			if not all(results):
+				return
+		await self.blocking(self.pipeline.commit_update, update)
+		police_stats = police.get_cache_stats()
+		logger.info(f"baza-gai.com.ua cache: {police_stats['hits']} hits, {police_stats['misses']} misses")
+
+	# ===== WD =====
+	async def wd_get(self, session, url, data, proxy=None, parse_page=False):
+		"""GET к WD с лимитом и повторным логином; возвращает (status, bytes) или None.
+
+		С parse_page=True успешный ответ кусками складывается в blacklist.RawPage,
+		которая и возвращается вместо bytes.
+		"""
+		for attempt in range(2):
+			auth_time = getattr(session, 'wd_auth_time', None)
+			async with self.limits['wd']:
+				await asyncio.sleep(utils.rate_limiter.reserve(url))
+				started = self.loop.time()
+				try:
+					self.http.cookie_jar.update_cookies(session_cookies(session), URL(url))
+					async with self.http.get(url, data=data, proxy=proxy, headers=HEADERS) as response:
+						status = response.status
+						latency = self.loop.time() - started
+						metrics.observe_request(url, status, latency)
+						expired = (
+							attempt == 0 and getattr(session, 'wd_credentials', None)
+							and (status == 401 or '/Account/LogOn' in str(response.url))
+						)
+						if expired:
+							body = None
+						elif parse_page and status < 400:
+							page = blacklist.RawPage()
+							async for chunk in response.content.iter_chunked(blacklist.BLACKLIST_CHUNK_SIZE):
+								page.feed(chunk)
+							body = await self.blocking(page.close)
+						else:
+							body = await response.read()
+					if proxy:
+						utils.proxy_pool.report_success(proxy, latency)
+				except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as EX:
+					logger.warning(f'Async request to {url} failed: {EX!r}')
+					metrics.observe_request(url, None, self.loop.time() - started)
+					if proxy:
+						utils.proxy_pool.report_failure(proxy)
+					return None
+			if expired:
+				logger.info('WD session expired, logging in again')
+				if await self.blocking(utils.reauthenticate, session, auth_time):
+					continue
+			await self.sync_cookies(session, url)
+			return status, body
+		return None
+
+	async def sync_cookies(self, session, url):
+		"""Переносит обновлённые WD куки из aiohttp в requests-сессию и файл кук"""
+		cookies = {name: morsel.value for name, morsel in self.http.cookie_jar.filter_cookies(URL(url)).items()}
+		if not cookies.items() <= session_cookies(session).items():
+			await self.blocking(utils.merge_session_cookies, session, cookies)
+
+	async def fetch_black_list_page(self, session, server_id, page=1):
+		"""Страница чёрного списка сервера (blacklist.RawPage) или None"""
+		url = blacklist.BLACKLIST_URL
+		data = blacklist.black_list_query(server_id, page)
+		result = await self.wd_get(session, url, data, parse_page=True)
+		if result is not None and result[0] == 503:
+			proxy = utils.proxy_pool.choose()
+			if proxy:
+				logger.warning('Got 503 from WD, trying with proxy...')
+				result = await self.wd_get(session, url, data, proxy=proxy, parse_page=True)
+		if result is None or result[0] >= 400:
+			error_msg = f'Could not fetch blacklist for server {server_id} (page {page}): {result[0] if result else "no response"}'
+			logger.error(error_msg)
+			if self.on_error:
+				self.on_error('WD Blacklist Fetch Failed', error_msg, 'ERROR')
+			return None
+		return result[1]
+
+	async def download_black_list(self, session):
+		"""Все страницы всех серверов (blacklist.BlacklistPages) или None.
+
+		Число страниц - по blacklist.page_count; страницы сервера после пустой
+		или после получения всех records строк не нужны, их запросы отменяются.
+		"""
+		servers = list(self.pipeline.servers)
+		first_pages = await asyncio.gather(*(self.fetch_black_list_page(session, server) for server in servers))
+		if any(page is None for page in first_pages):
+			return None
+		pages = {(server, 1): page for server, page in zip(servers, first_pages)}
+		tasks = {
+			server: [(page, asyncio.ensure_future(self.fetch_black_list_page(session, server, page))) for page in range(2, blacklist.page_count(first) + 1)]
+			for server, first in zip(servers, first_pages)
+		}
+		try:
+			for (server, server_tasks), first in zip(tasks.items(), first_pages):
+				rows = first.rows
+				for index, (page, task) in enumerate(server_tasks):
+					result = await task
+					if result is None:
+						return None
+					pages[(server, page)] = result
+					rows += result.rows
+					if blacklist.is_last_page(first, result, rows):
+						for page, rest in server_tasks[index + 1:]:
+							rest.cancel()
+						break
+		finally:
+			for server_tasks in tasks.values():
+				for page, task in server_tasks:
+					task.cancel()
+		return blacklist.BlacklistPages(servers, pages)
+
+	# ===== FIREBIRD + СОВПАДЕНИЯ =====
+	async def process_taxi(self, session, taxi, black_list, plates, plate_index, driver_index=None):
+		"""Загрузка автопарка, поиск совпадений, проверка в baza-gai и постановка уведомлений"""
+		with logger.contextualize(taxi=taxi):
+			try:
+				taxi_name, chat_id, cars = await asyncio.wait_for(
+					self.blocking(self.pipeline.get_fleet, taxi, plates, executor=self.executor),
+					self.pipeline.fetch_timeout,
+				)
+			except asyncio.TimeoutError:
+				error_msg = f'Fetching car data from {taxi} took longer than {self.pipeline.fetch_timeout:.0f}s, skipping this cycle'
+				logger.error(error_msg)
+				if self.on_error:
+					self.on_error('Car Data Fetch Timeout', error_msg, 'ERROR', source=f'fetch_fleets {taxi}')
+				return False
+			except Exception as EX:
+				logger.exception(f'❌ Error fetching {taxi}: {EX}')
+				return False
+			if cars is None:
+				logger.warning(f'Failed to get car data for {taxi}')
+				return False
+
+			with metrics.stage('taxi_process', taxi=taxi):
+				hits, near_misses = await self.blocking(self.find_matches, taxi, cars, black_list, plate_index)
+				stats_future = None
+				if self.pipeline.get_stats and hits:
+					# Статистика WD идёт своим пулом потоков одновременно с запросами к baza-gai
+					stats_future = asyncio.ensure_future(self.blocking(self.pipeline.get_stats, session, hits, taxi_name))
+				police_infos = await self.police_lookups(hits + [fleet_plate for carnum, fleet_plate in near_misses])
+				statistics = await stats_future if stats_future else {}
+				await self.blocking(
+					self.save_results, taxi, taxi_name, chat_id, cars, black_list, plate_index,
+					hits, near_misses, police_infos, statistics, driver_index,
+				)
+			return True
+
+	def find_matches(self, taxi, cars, black_list, plate_index):
+		"""(находки, возможные совпадения) автопарка"""
+		hits = self.pipeline.find_hits(taxi, cars, black_list, plate_index)
+		near_misses = self.pipeline.find_near_misses(taxi, cars, black_list, plate_index) if self.pipeline.find_near_misses else []
+		return hits, near_misses
+
+	def save_results(self, taxi, taxi_name, chat_id, cars, black_list, plate_index, hits, near_misses, police_infos, statistics, driver_index):
+		"""Тексты уведомлений, отметки в processed_cars и очередь outbox"""
+		with metrics.stage('render', taxi=taxi):
+			found = enrichment.render_hits(hits, cars, black_list, police_infos, statistics)
+			possible = enrichment.render_near_misses(near_misses, cars, black_list, police_infos)
+		records = []
+		for carnum, message in found:
+			logger.info(f'✅ FOUND: {carnum}')
+			records.append((taxi, carnum))
+		for (carnum, fleet_plate), message in possible:
+			logger.info(f'❔ POSSIBLE MATCH: {carnum} ~ {fleet_plate}')
+			records.append((taxi, database.near_miss_key(carnum, fleet_plate)))
+		messages = [(chat_id, message) for key, message in found + possible]
+		self.db.save_notifications(records, messages)
+		if messages:
+			self.outbox.notify()
+		if driver_index is not None:
+			driver_index.add_fleet(taxi, taxi_name, chat_id, cars, black_list, plate_index)
+		logger.info(f'✅ {taxi_name}: {len(found)} new blocked cars found')
+
+	# ===== BAZA-GAI.COM.UA =====
+	async def police_lookups(self, carnums):
+		"""{номер: данные baza-gai} для пачки номеров: кэш - одним запросом, остальные - параллельно"""
+		plates = {carnum: police.normalize_plate(carnum) for carnum in carnums}
+		found = await self.blocking(police.lookup_cache_many, set(plates.values()))
+		missing = list(set(plates.values()) - found.keys())
+		found.update(zip(missing, await asyncio.gather(*(self.police_lookup(plate) for plate in missing))))
+		return {carnum: found[plate] for carnum, plate in plates.items()}
+
+	async def police_lookup(self, plate):
+		"""Запрос номера, который уже идёт для другого такси, не повторяется, а ожидается"""
+		task = self.police_tasks.get(plate)
+		if task is None:
+			task = self.police_tasks[plate] = asyncio.ensure_future(self.fetch_police(plate))
+			task.add_done_callback(lambda task: self.police_tasks.pop(plate, None))
+		return await asyncio.shield(task)
+
+	async def fetch_police(self, plate):
+		cached, data = await self.blocking(police.lookup_cache, plate)
+		if cached:
+			return data
+		async with self.limits['police']:
+			await asyncio.sleep(utils.rate_limiter.reserve(police.POLICE_URL))
+			started = self.loop.time()
+			try:
+				async with self.http.get(
+					police.POLICE_URL, data={'digits': plate}, headers=HEADERS,
+					timeout=aiohttp.ClientTimeout(total=police.POLICE_TIMEOUT),
+				) as response:
+					metrics.observe_request(police.POLICE_URL, response.status, self.loop.time() - started)
+					if response.status >= 400:
+						logger.warning(f'baza-gai.com.ua lookup failed for {plate}: {response.status}')
+						return None
+					html = await response.text()
+			except (aiohttp.ClientError, asyncio.TimeoutError) as EX:
+				metrics.observe_request(police.POLICE_URL, None, self.loop.time() - started)
+				logger.warning(f'baza-gai.com.ua lookup failed for {plate}: {EX!r}')
+				return None
+		return await self.blocking(police.store_page, plate, html)
@@ -0,0 +1 @@
+"""Офлайн-бенчмарк цикла проверки: python -m benchmark --help"""
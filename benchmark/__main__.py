@@ -0,0 +1,236 @@
+"""Бенчмарк цикла проверки на локальных заменителях WD, Firebird и Telegram.
+
+Пример: python -m benchmark --blacklist 100000 --fleet 50000 --hits 200
+
+Сценарии:
+  initial   - первый цикл: весь чёрный список новый, проверяются все такси
+  unchanged - чёрный список не изменился (пропуск по хэшу)
+  full-scan - полная перепроверка (все совпадения уже отправлены)
+После initial отдельно замеряется время доставки всех уведомлений.
+"""
+import argparse
+import json
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from time import monotonic, sleep
+from urllib.request import urlopen
+
+from benchmark import data, stands
+
+TAXIS = {
+	'Jet': ('JET', 'Джет'),
+	'Fly': ('FLY', 'Флай'),
+	'Magdack': ('MAGDACK', 'МагДак'),
+	'898': ('TAXI898', '898'),
+	'Allo': ('ALLO', 'Алло'),
+}
+BLACKLIST_SERVERS = (303, 296)
+
+
+class StageTimer:
+	"""Время по этапам: число вызовов, сумма и максимум"""
+
+	def __init__(self):
+		self.stages = defaultdict(lambda: [0, 0.0, 0.0])
+		self.lock = threading.Lock()
+
+	def wrap(self, name, func):
+		def timed(*args, **kwargs):
+			started = monotonic()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				elapsed = monotonic() - started
+				with self.lock:
+					stage = self.stages[name]
+					stage[0] += 1
+					stage[1] += elapsed
+					stage[2] = max(stage[2], elapsed)
+		return timed
+
+	def reset(self):
+		with self.lock:
+			self.stages.clear()
+
+	def snapshot(self):
+		with self.lock:
+			return {name: {'calls': calls, 'total': round(total, 3), 'max': round(longest, 3)} for name, (calls, total, longest) in self.stages.items()}
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(prog='python -m benchmark', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--blacklist', type=int, default=100000, help='записей в чёрном списке')
+	parser.add_argument('--fleet', type=int, default=50000, help='машин в автопарке каждого такси')
+	parser.add_argument('--hits', type=int, default=200, help='машин из чёрного списка в каждом автопарке')
+	parser.add_argument('--taxis', type=int, default=len(TAXIS), help='сколько такси проверять (1-5)')
+	parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads')
+	parser.add_argument('--cardata-mode', choices=['full', 'pushdown'], default='full')
+	parser.add_argument('--page-size', type=int, default=5000, help='BLACKLIST_PAGE_SIZE')
+	parser.add_argument('--wd-latency', type=float, default=0.0, help='задержка ответа WD, сек')
+	parser.add_argument('--police-latency', type=float, default=0.0, help='задержка ответа baza-gai, сек')
+	parser.add_argument('--telegram-latency', type=float, default=0.0, help='задержка ответа Telegram, сек')
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--json', help='сохранить результаты в файл')
+	parser.add_argument('--metrics', help='сохранить метрики приложения (формат /metrics) в файл')
+	parser.add_argument('--verbose', action='store_true', help='показывать логи приложения')
+	return parser.parse_args()
+
+
+def configure_environment(args, workdir, base_url, fleet_paths):
+	"""Переменные окружения до импорта модулей приложения (load_dotenv их не перезапишет)"""
+	os.environ.update({
+		'TELEGRAM_BOT_TOKEN': '123456:bench',
+		'TELEGRAM_ERROR_BOT_TOKEN': '',
+		'SENTRY_DSN': '',
+		'WD_LOGIN': 'bench',
+		'WD_PASSWORD': 'bench',
+		'WD_BASE_URL': base_url,
+		'POLICE_URL': f'{base_url}/search?',
+		'WD_COOKIES_FILE': os.path.join(workdir, 'wd_cookies.json'),
+		'RATE_LIMITS': '127.0.0.1=100000:100000',
+		'PROXY_LIST': '',
+		'ENGINE': args.engine,
+		'CARDATA_MODE': args.cardata_mode,
+		'BLACKLIST_PAGE_SIZE': str(args.page_size),
+		'TELEGRAM_CHAT_INTERVAL': '0',
+		'TELEGRAM_GLOBAL_RATE': '100000',
+		'RECORD_MODE': '',
+		'DEBUG': 'False',
+	})
+	for taxi, (prefix, name) in TAXIS.items():
+		os.environ.update({
+			f'{prefix}_HOST': 'localhost',
+			f'{prefix}_DB': fleet_paths.get(taxi, ''),
+			f'{prefix}_NAME': name,
+			f'{prefix}_CHAT_ID': str(-1000 - len(prefix)),
+		})
+
+
+def peak_rss_mb():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def stand_stats(base_url):
+	with urlopen(f'{base_url}/__stats') as response:
+		return json.load(response)
+
+
+def wait_outbox_empty(db, timeout=600):
+	started = monotonic()
+	while db.count_messages():
+		if monotonic() - started > timeout:
+			raise TimeoutError('Outbox was not drained')
+		sleep(0.05)
+	return monotonic() - started
+
+
+def main():
+	args = parse_args()
+	workdir = tempfile.mkdtemp(prefix='wd-bench-')
+	taxis = list(TAXIS)[:max(1, min(args.taxis, len(TAXIS)))]
+
+	print(f'Generating {args.blacklist} blacklist entries and {len(taxis)} fleets of {args.fleet} cars in {workdir}...')
+	blacklist = data.generate_blacklist(args.blacklist, BLACKLIST_SERVERS, args.seed)
+	blacklist_plates = [plate for entries in blacklist.values() for plate, reason in entries]
+	fleet_paths = {}
+	for position, taxi in enumerate(taxis):
+		fleet_paths[taxi] = os.path.join(workdir, f'{taxi}.sqlite')
+		data.write_fleet_db(fleet_paths[taxi], data.generate_fleet(args.fleet, blacklist_plates, args.hits, args.seed + position))
+	del blacklist_plates
+
+	latency = {'blacklist': args.wd_latency, 'orders': args.wd_latency, 'groups': args.wd_latency, 'logon': args.wd_latency, 'police': args.police_latency, 'telegram': args.telegram_latency}
+	stand, base_url = stands.start_stands({str(server): entries for server, entries in blacklist.items()}, latency)
+	del blacklist
+	configure_environment(args, workdir, base_url, fleet_paths)
+	os.chdir(workdir)
+
+	from loguru import logger
+	logger.remove()
+	logger.add(sys.stderr, level='DEBUG' if args.verbose else 'WARNING')
+
+	import telebot
+	telebot.apihelper.API_URL = f'{base_url}/bot{{0}}/{{1}}'
+
+	import main as app
+	import database
+	import enrichment
+	import firebird_pool
+	import metrics
+	import police
+	import utils
+
+	timer = StageTimer()
+	app.TAXIS_LIST = taxis
+	app.download_black_list = timer.wrap('blacklist download', app.download_black_list)
+	app.build_black_list_update = timer.wrap('blacklist diff', app.build_black_list_update)
+	app.fetch_taxi = timer.wrap('fleet fetch (per taxi)', app.fetch_taxi)
+	app.find_hits = timer.wrap('matching (per taxi)', app.find_hits)
+	app.process_taxi = timer.wrap('hits + enqueue (per taxi)', app.process_taxi)
+	police.check_in_police = timer.wrap('baza-gai lookup', police.check_in_police)
+	enrichment.render_hits = timer.wrap('render (per taxi)', enrichment.render_hits)
+	app.commit_black_list = timer.wrap('snapshot commit', app.commit_black_list)
+
+	app.firebird_pool.pool = firebird_pool.FirebirdPool(
+		connect=lambda host, database: sqlite3.connect(database, check_same_thread=False),
+		validation_sql='SELECT 1',
+	)
+	app.db = database.Database(os.path.join(workdir, 'processed_cars.db'))
+	police.init_cache(app.db)
+	app.engine, app.outbox_dispatcher = app.start_delivery()
+	app.session = utils.get_wd_session('bench', 'bench')
+	if app.session is None:
+		raise SystemExit('Could not log in to the WD stand-in')
+
+	results = {'parameters': vars(args), 'scenarios': {}}
+	for scenario, full_scan in (('initial', False), ('unchanged', False), ('full-scan', True)):
+		timer.reset()
+		before = stand_stats(base_url)
+		started = monotonic()
+		app.run_cycle(full_scan)
+		cycle_time = monotonic() - started
+		drain_time = wait_outbox_empty(app.db)
+		after = stand_stats(base_url)
+		requests = {route: count - before['requests'].get(route, 0) for route, count in after['requests'].items()}
+		requests = {route: count for route, count in requests.items() if count}
+		results['scenarios'][scenario] = {
+			'cycle_seconds': round(cycle_time, 3),
+			'outbox_drain_seconds': round(drain_time, 3),
+			'messages_sent': after['messages'] - before['messages'],
+			'requests': requests,
+			'requests_per_second': round(sum(requests.values()) / (cycle_time + drain_time), 1) if requests else 0.0,
+			'peak_rss_mb': round(peak_rss_mb(), 1),
+			'stages': timer.snapshot(),
+		}
+
+	app.stop_delivery()
+	app.firebird_pool.pool.close_all()
+	stand.terminate()
+	report(results)
+	if args.json:
+		with open(args.json, 'w', encoding='utf-8') as file:
+			json.dump(results, file, ensure_ascii=False, indent=2)
+	if args.metrics:
+		with open(args.metrics, 'w', encoding='utf-8') as file:
+			file.write(metrics.registry.render())
+
+
+def report(results):
+	parameters = results['parameters']
+	print(f"\nblacklist={parameters['blacklist']} fleet={parameters['fleet']} hits={parameters['hits']} taxis={parameters['taxis']} "
+		f"engine={parameters['engine']} cardata={parameters['cardata_mode']} page={parameters['page_size']}")
+	for scenario, result in results['scenarios'].items():
+		print(f"\n== {scenario}: cycle {result['cycle_seconds']:.2f}s, outbox drain {result['outbox_drain_seconds']:.2f}s, "
+			f"{result['messages_sent']} messages, {result['requests_per_second']} req/s, peak RSS {result['peak_rss_mb']:.0f} MB")
+		if result['requests']:
+			print('   requests: ' + ', '.join(f'{route}={count}' for route, count in sorted(result['requests'].items())))
+		for name, stage in result['stages'].items():
+			print(f"   {name:<28} calls={stage['calls']:<6} total={stage['total']:>8.3f}s  max={stage['max']:>7.3f}s")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,81 @@
+"""Генераторы синтетических данных для бенчмарка"""
+import random
+import sqlite3
+
+PLATE_LETTERS = 'ABCEHIKMOPTX'
+CYRILLIC = str.maketrans('ABCEHIKMOPTX', 'АВСЕНІКМОРТХ')
+REASONS = ['Не соответствует требованиям сервера', 'Нарушение правил', 'Задолженность', 'Жалобы клиентов']
+MARKS = ['Skoda Octavia', 'Toyota Camry', 'Hyundai Elantra', 'Kia Rio', 'Renault Logan']
+COLORS = ['Белый', 'Чёрный', 'Серый', 'Синий']
+
+
+def random_plate(rng):
+	return (
+		''.join(rng.choice(PLATE_LETTERS) for _ in range(2))
+		+ f'{rng.randrange(10000):04d}'
+		+ ''.join(rng.choice(PLATE_LETTERS) for _ in range(2))
+	)
+
+
+def unique_plates(rng, count, taken=None):
+	taken = set() if taken is None else taken
+	plates = []
+	while len(plates) < count:
+		plate = random_plate(rng)
+		if plate not in taken:
+			taken.add(plate)
+			plates.append(plate)
+	return plates
+
+
+def generate_blacklist(size, servers, seed=1):
+	"""{сервер: [(номер, причина)]} - size записей, поровну между серверами"""
+	rng = random.Random(seed)
+	plates = unique_plates(rng, size)
+	per_server = {server: [] for server in servers}
+	for position, plate in enumerate(plates):
+		per_server[servers[position % len(servers)]].append((plate, rng.choice(REASONS)))
+	return per_server
+
+
+def generate_fleet(size, blacklist_plates, hits, seed=1):
+	"""Строки автопарка: size машин, из них hits - из чёрного списка (часть - кириллицей)"""
+	rng = random.Random(seed)
+	taken = set(blacklist_plates)
+	matched = rng.sample(blacklist_plates, min(hits, len(blacklist_plates)))
+	plates = [
+		plate.translate(CYRILLIC) if position % 4 == 0 else plate
+		for position, plate in enumerate(matched)
+	]
+	plates += unique_plates(rng, size - len(plates), taken)
+	rng.shuffle(plates)
+	rows = []
+	for signal, plate in enumerate(plates, 1):
+		rows.append((
+			signal, plate, rng.choice(MARKS), rng.randrange(2005, 2024), rng.choice(COLORS),
+			f'2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d} 10:00:00.000',
+			round(rng.uniform(-500, 2000), 2),
+			'Иванов', 'Иван', 'Иванович',
+			f'050{rng.randrange(10 ** 7):07d}', '', f'067{rng.randrange(10 ** 7):07d}',
+		))
+	return rows
+
+
+def write_fleet_db(path, rows):
+	"""SQLite с таблицами Cars / DriverCar / Drivers, как в базе такси"""
+	conn = sqlite3.connect(path)
+	conn.executescript('''
+		DROP TABLE IF EXISTS "Cars";
+		DROP TABLE IF EXISTS "DriverCar";
+		DROP TABLE IF EXISTS "Drivers";
+		CREATE TABLE "Cars" ("Car_No" TEXT, "Marka" TEXT, "Year" INTEGER, "Color" TEXT, "Signal" INTEGER PRIMARY KEY);
+		CREATE TABLE "DriverCar" ("Signal" INTEGER, "Open_Time" TEXT, "Duty" REAL, "Driver_No" INTEGER);
+		CREATE TABLE "Drivers" ("Driver_No" INTEGER PRIMARY KEY, "F" TEXT, "I" TEXT, "O" TEXT, "Phone1" TEXT, "Phone2" TEXT, "MPhone" TEXT);
+		CREATE INDEX cars_no ON "Cars" ("Car_No");
+		CREATE INDEX drivercar_signal ON "DriverCar" ("Signal");
+	''')
+	conn.executemany('INSERT INTO "Cars" VALUES (?, ?, ?, ?, ?)', [(row[1], row[2], row[3], row[4], row[0]) for row in rows])
+	conn.executemany('INSERT INTO "DriverCar" VALUES (?, ?, ?, ?)', [(row[0], row[5], row[6], row[0]) for row in rows])
+	conn.executemany('INSERT INTO "Drivers" VALUES (?, ?, ?, ?, ?, ?, ?)', [(row[0],) + row[7:] for row in rows])
+	conn.commit()
+	conn.close()
@@ -0,0 +1,135 @@
+"""Локальные заменители WD, baza-gai.com.ua и Telegram Bot API для бенчмарка.
+
+Сервер работает в отдельном процессе, чтобы его работа не искажала время
+и память измеряемого цикла.
+"""
+import json
+import multiprocessing
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+
+AUTH_COOKIE = '.ASPXAUTH'
+ROUTES = {
+	'/Account/LogOn': 'logon',
+	'/CarInfoBlackByGroup/SearchData/': 'blacklist',
+	'/Order/SearchData': 'orders',
+	'/TaxiGroup/SelectByGroup': 'groups',
+	'/search': 'police',
+}
+
+
+class StandServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, blacklist, latency):
+		super().__init__(('127.0.0.1', 0), StandHandler)
+		self.blacklist = blacklist			# {сервер: [(номер, причина)]}
+		self.latency = latency				# {маршрут: секунды}
+		self.requests = Counter()
+		self.messages = 0
+		self.lock = threading.Lock()
+
+
+class StandHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		pass
+
+	def params(self):
+		length = int(self.headers.get('Content-Length') or 0)
+		body = self.rfile.read(length).decode() if length else ''
+		if body.startswith('{'):
+			return json.loads(body)
+		query = parse_qs(urlsplit(self.path).query)
+		query.update(parse_qs(body))
+		return {name: values[0] for name, values in query.items()}
+
+	def reply(self, status, body=b'', content_type='application/json; charset=utf-8', headers=()):
+		if isinstance(body, (dict, list)):
+			body = json.dumps(body, ensure_ascii=False).encode()
+		elif isinstance(body, str):
+			body = body.encode()
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for name, value in headers:
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def route(self):
+		path = urlsplit(self.path).path
+		if path.startswith('/bot') and path.endswith('/sendMessage'):
+			return 'telegram'
+		return ROUTES.get(path)
+
+	def do_GET(self):
+		self.handle_request()
+
+	def do_POST(self):
+		self.handle_request()
+
+	def handle_request(self):
+		route = self.route()
+		params = self.params()
+		if urlsplit(self.path).path == '/__stats':
+			with self.server.lock:
+				return self.reply(200, {'requests': dict(self.server.requests), 'messages': self.server.messages})
+		if route is None:
+			return self.reply(404, {'error': 'not found'})
+		with self.server.lock:
+			self.server.requests[route] += 1
+		if self.server.latency.get(route):
+			sleep(self.server.latency[route])
+
+		if route == 'logon':
+			if self.command == 'POST':
+				return self.reply(200, '<html>ok</html>', 'text/html; charset=utf-8', [('Set-Cookie', f'{AUTH_COOKIE}=bench; Path=/')])
+			return self.reply(200, '<html>login</html>', 'text/html; charset=utf-8')
+		if route == 'telegram':
+			with self.server.lock:
+				self.server.messages += 1
+			chat = {'id': int(params.get('chat_id', 0)), 'type': 'supergroup'}
+			return self.reply(200, {'ok': True, 'result': {'message_id': self.server.messages, 'date': 0, 'chat': chat, 'text': params.get('text', '')}})
+		if route == 'police':
+			return self.reply(200, '<html><small>нет данных</small></html>', 'text/html; charset=utf-8')
+		if AUTH_COOKIE not in (self.headers.get('Cookie') or ''):
+			return self.reply(302, b'', headers=[('Location', '/Account/LogOn?ReturnUrl=%2f')])
+		if route == 'blacklist':
+			return self.blacklist_page(params)
+		if route == 'groups':
+			return self.reply(200, {'1': 'Флай', '2': 'Джет', '3': 'МагДак', '4': '898', '5': 'Алло'})
+		if route == 'orders':
+			return self.reply(200, {'total': 0, 'page': 1, 'records': 0, 'rows': []})
+
+	def blacklist_page(self, params):
+		entries = self.server.blacklist.get(str(params.get('Group.Id')), [])
+		rows = int(params.get('rows', 5000))
+		page = int(params.get('page', 1))
+		chunk = entries[(page - 1) * rows:page * rows]
+		return self.reply(200, {
+			'total': -(-len(entries) // rows),
+			'page': page,
+			'records': len(entries),
+			'rows': [{'id': plate, 'cell': [plate, reason]} for plate, reason in chunk],
+		})
+
+
+def serve(blacklist, latency, ready):
+	server = StandServer(blacklist, latency)
+	ready.send(server.server_address[1])
+	server.serve_forever()
+
+
+def start_stands(blacklist, latency):
+	"""Запускает сервер в отдельном процессе; возвращает (процесс, базовый URL)"""
+	parent, child = multiprocessing.Pipe()
+	process = multiprocessing.Process(target=serve, args=(blacklist, latency, child), daemon=True)
+	process.start()
+	port = parent.recv()
+	return process, f'http://127.0.0.1:{port}'
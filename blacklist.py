@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import re
+
+import utils
+
+BLACKLIST_URL = f'{utils.WD_BASE_URL}/CarInfoBlackByGroup/SearchData/'
+BLACKLIST_PAGE_SIZE = int(os.getenv('BLACKLIST_PAGE_SIZE', '5000'))		# Записей на странице ответа WD
+BLACKLIST_WORKERS = int(os.getenv('BLACKLIST_WORKERS', '4'))			# Страниц, загружаемых одновременно
+BLACKLIST_CHUNK_SIZE = 64 * 1024										# Размер куска при чтении ответа
+
+RAW_ROWS_START = re.compile(rb'"rows"\s*:\s*\[')
+RAW_GRID_FIELD = re.compile(rb'"(total|records|page)"\s*:\s*"?(\d+)')
+# Ключ "cell" есть в каждой строке jqGrid; внутри строк JSON кавычки экранированы
+RAW_ROW = re.compile(rb'"cell"\s*:')
+
+
+def black_list_query(server_id, page=1):
+	"""Параметры запроса страницы чёрного списка одного сервера WD"""
+	return {"Group.Id":server_id,"_search":"true","rows":str(BLACKLIST_PAGE_SIZE),"page":str(page),"sidx":"Id","sord":"asc","User.FullName":"СОЗ"}
+
+
+class RawPage:
+	"""Страница jqGrid с чёрным списком в сыром виде.
+
+	Ответ подаётся кусками через feed(), по ним считается SHA-256. Из сырых
+	байт читаются только поля total и records и число строк; сами строки
+	разбираются в parse(), когда хэш всех страниц показал, что список изменился.
+	"""
+
+	def __init__(self):
+		self.data = bytearray()
+		self.total = None						# Всего страниц (jqGrid total)
+		self.records = None						# Всего записей (jqGrid records)
+		self.rows = 0
+		self.digest = hashlib.sha256()
+
+	def feed(self, chunk):
+		self.digest.update(chunk)
+		self.data += chunk
+
+	def close(self):
+		"""Завершает загрузку; ValueError, если ответ оборвался или это не jqGrid"""
+		match = RAW_ROWS_START.search(self.data)
+		if match is None:
+			# Пустой ответ jqGrid может прийти без "rows"
+			result = json.loads(self.data)
+			self.total = int(result['total'])
+			self.records = int(result.get('records') or 0)
+			return self
+		if not self.data.rstrip().endswith(b'}'):
+			raise ValueError(f'Blacklist page truncated after {len(self.data)} bytes')
+		fields = RAW_GRID_FIELD.findall(self.data, 0, match.start())
+		fields += RAW_GRID_FIELD.findall(self.data, self.data.rfind(b']'))
+		for name, value in fields:
+			if name in (b'total', b'records'):
+				setattr(self, name.decode(), int(value))
+		if self.total is None:
+			raise ValueError('Blacklist page has no "total" field')
+		self.rows = len(RAW_ROW.findall(self.data, match.end()))
+		return self
+
+	def parse(self):
+		"""{номер: причина} со страницы; ValueError, если это не JSON"""
+		return {row['cell'][0]: row['cell'][1] for row in json.loads(self.data).get('rows') or ()}
+
+
+def read_page(chunks):
+	"""Сырая страница (RawPage) из итератора кусков bytes"""
+	page = RawPage()
+	for chunk in chunks:
+		page.feed(chunk)
+	return page.close()
+
+
+def page_count(first):
+	"""Сколько страниц загружать по первой странице сервера.
+
+	Размер страницы - число строк на первой странице, а не запрошенный
+	BLACKLIST_PAGE_SIZE: WD может отдавать меньше строк, чем просили. Если
+	records известно, страниц ceil(records / строк на странице) - завышенный
+	jqGrid total лишних запросов не даёт.
+	"""
+	if first.rows == 0:
+		return 1
+	if first.records is not None:
+		return -(-first.records // first.rows)
+	return first.total
+
+
+def is_last_page(first, page, rows):
+	"""После page загружать нечего: она пустая или с сервера уже получено rows >= records строк"""
+	return page.rows == 0 or (first.records is not None and rows >= first.records)
+
+
+class BlacklistPages:
+	"""Все загруженные страницы {(сервер, страница): RawPage}.
+
+	Хэш содержимого считается по сырым байтам в порядке серверов и страниц,
+	а чёрный список собирается только в entries() - если хэш совпал с
+	проверенным снимком, строки страниц не разбираются вовсе.
+	"""
+
+	def __init__(self, servers, pages):
+		self.servers = servers
+		self.pages = pages
+		self.keys = sorted(pages, key=lambda key: (servers.index(key[0]), key[1]))
+		self.content_hash = content_hash((f'{server_id}/{page}', pages[(server_id, page)].digest.digest()) for server_id, page in self.keys)
+
+	def rows(self, server_id):
+		"""Строк, полученных с сервера"""
+		return sum(self.pages[key].rows for key in self.keys if key[0] == server_id)
+
+	def entries(self):
+		"""Чёрный список {номер: причина}; ValueError, если страница не разбирается"""
+		black_list = {}
+		for key in self.keys:
+			black_list.update(self.pages[key].parse())
+		return black_list
+
+
+class BlacklistDiff:
+	"""Разница между двумя снимками чёрного списка"""
+
+	def __init__(self, added, removed, changed):
+		self.added = added			# {номер: причина} - новые записи
+		self.removed = removed		# {номер: причина} - исчезнувшие записи
+		self.changed = changed		# {номер: (старая причина, новая причина)}
+
+	def new_entries(self, black_list):
+		"""Записи, которые нужно проверить полностью: новые и со сменой причины"""
+		entries = dict(self.added)
+		for carnum in self.changed:
+			entries[carnum] = black_list[carnum]
+		return entries
+
+	def __bool__(self):
+		return bool(self.added or self.removed or self.changed)
+
+	def __str__(self):
+		return f'+{len(self.added)} / -{len(self.removed)} / ~{len(self.changed)}'
+
+
+def diff_blacklists(old, new):
+	"""Сравнивает два снимка {номер: причина}"""
+	added = {carnum: reason for carnum, reason in new.items() if carnum not in old}
+	removed = {carnum: reason for carnum, reason in old.items() if carnum not in new}
+	changed = {
+		carnum: (old[carnum], reason)
+		for carnum, reason in new.items()
+		if carnum in old and old[carnum] != reason
+	}
+	return BlacklistDiff(added, removed, changed)
+
+
+def content_hash(parts):
+	"""SHA-256 от сырых ответов WD (список пар (сервер или страница, bytes))"""
+	digest = hashlib.sha256()
+	for server_id, raw in parts:
+		digest.update(str(server_id).encode())
+		digest.update(b'\0')
+		digest.update(raw)
+		digest.update(b'\0')
+	return digest.hexdigest()
+
+
+class BlacklistUpdate:
+	"""Свежий чёрный список вместе с разницей относительно последнего проверенного снимка"""
+
+	def __init__(self, black_list, diff, content_hash, full_scan):
+		self.black_list = black_list
+		self.diff = diff
+		self.content_hash = content_hash
+		self.full_scan = full_scan		# Нужна полная перепроверка всего списка
+
+	def to_check(self):
+		"""Записи, которые нужно сравнить с автопарками в этом цикле"""
+		if self.full_scan:
+			return self.black_list
+		return self.diff.new_entries(self.black_list)
@@ -0,0 +1,105 @@
+import os
+import threading
+
+import telebot
+from loguru import logger
+
+import fleet
+import fleet_store
+import metrics
+
+BOT_COMMANDS = os.getenv('BOT_COMMANDS', 'False').lower() == 'true'		# Отвечать на /plate и /phone
+# Чаты, кроме чатов такси, которым разрешены команды (через запятую)
+BOT_ALLOWED_CHATS = {int(chat) for chat in os.getenv('BOT_ALLOWED_CHATS', '').split(',') if chat.strip()}
+MAX_RESULTS = 20
+HELP_TEXT = (
+	'Поиск по последним снимкам автопарков (без запроса в базы такси):\n'
+	'/plate AA1234BB - машина с номером\n'
+	'/phone 0501234567 - машины водителя с телефоном'
+)
+
+
+def render_car(taxi_name, car, updated_at):
+	""" Строка ответа о машине из снимка автопарка """
+	driver = ' '.join(part for part in (car.f, car.i, car.o) if part)
+	phones = fleet.row_phones([car[name] for name in fleet.CarRecord.__slots__])
+	text = f'🚕 {taxi_name}: {car.number}, позывной {car.signal}\n{car.marka}, {car.year}, {car.color}'
+	if driver:
+		text += f'\n{driver}'
+	if phones:
+		text += '\n' + ', '.join(phones)
+	if car.balans is not None:
+		text += f'\nБаланс: {round(car.balans, 2)}'
+	if updated_at:
+		text += f"\nСнимок от {updated_at.strftime('%d.%m.%Y %H:%M')}"
+	return text
+
+
+class BotCommands:
+	""" Команды бота /plate и /phone по снимкам автопарков в SQLite.
+
+	Отвечают только в чатах такси и в BOT_ALLOWED_CHATS. Обновления бот
+	получает long polling'ом в фоновом потоке.
+	"""
+
+	def __init__(self, bot, db, taxis, allowed_chats=BOT_ALLOWED_CHATS):
+		self.bot = bot
+		self.db = db
+		self.taxis = taxis					# {taxi: название такси}
+		self.allowed_chats = set(allowed_chats)
+		self.thread = None
+		bot.message_handler(commands=['plate'], func=self.allowed)(self.plate)
+		bot.message_handler(commands=['phone'], func=self.allowed)(self.phone)
+		bot.message_handler(commands=['help', 'start'], func=self.allowed)(self.help)
+
+	def allowed(self, message):
+		if message.chat.id in self.allowed_chats:
+			return True
+		logger.warning(f'Ignoring bot command from unknown chat {message.chat.id}')
+		return False
+
+	def help(self, message):
+		self.bot.reply_to(message, HELP_TEXT)
+
+	def plate(self, message):
+		plate = telebot.util.extract_arguments(message.text).strip()
+		if not plate:
+			self.bot.reply_to(message, 'Укажите номер: /plate AA1234BB')
+			return
+		with metrics.stage('bot_lookup', command='plate'):
+			cars = fleet_store.find_by_plate(self.db, plate)
+			blocked = self.db.find_blacklist_reason(fleet.plate_variants(plate))
+		lines = []
+		if blocked:
+			lines.append(f'⛔ {blocked[0]} в чёрном списке: {blocked[1]}')
+		if not cars:
+			lines.append(f'Номер {fleet.normalize_plate(plate)} не найден в автопарках')
+		self.reply(message, lines, cars)
+
+	def phone(self, message):
+		phone = telebot.util.extract_arguments(message.text).strip()
+		if not fleet.normalize_phone(phone):
+			self.bot.reply_to(message, 'Укажите телефон: /phone 0501234567')
+			return
+		with metrics.stage('bot_lookup', command='phone'):
+			cars = fleet_store.find_by_phone(self.db, phone)
+		lines = [] if cars else [f'Телефон {fleet.normalize_phone(phone)} не найден в автопарках']
+		self.reply(message, lines, cars)
+
+	def reply(self, message, lines, cars):
+		updated = {taxi: fleet_store.snapshot_time(self.db, taxi) for taxi in {taxi for taxi, car in cars}}
+		lines += [render_car(self.taxis.get(taxi, taxi), car, updated[taxi]) for taxi, car in cars[:MAX_RESULTS]]
+		if len(cars) > MAX_RESULTS:
+			lines.append(f'... и ещё {len(cars) - MAX_RESULTS}')
+		self.bot.reply_to(message, '\n\n'.join(lines))
+
+	def start(self):
+		self.thread = threading.Thread(
+			target=self.bot.infinity_polling, kwargs={'timeout': 20, 'skip_pending': True},
+			name='bot-commands', daemon=True,
+		)
+		self.thread.start()
+		logger.info(f'Bot commands enabled for {len(self.allowed_chats)} chats')
+
+	def stop(self):
+		self.bot.stop_polling()
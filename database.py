@@ -1,5 +1,37 @@
 import sqlite3
 import threading
+import time
+from datetime import date, datetime
+from decimal import Decimal
+
+from loguru import logger
+
+# Значения из Firebird (снимки автопарков) сохраняются без поштучного преобразования
+sqlite3.register_adapter(Decimal, float)
+sqlite3.register_adapter(datetime, str)
+sqlite3.register_adapter(date, str)
+
+# Ключи processed_cars: найденная машина - номер из чёрного списка как есть,
+# остальные виды уведомлений - со своим префиксом
+NEAR_MISS_PREFIX = 'near:'
+PHONE_MATCH_PREFIX = 'phone:'
+SHARED_DRIVER_PREFIX = 'shared:'
+
+
+def near_miss_key(carnum, fleet_plate):
+	"""Возможное совпадение: уведомление один раз на пару номеров"""
+	return f'{NEAR_MISS_PREFIX}{carnum}~{fleet_plate}'
+
+
+def phone_match_key(phone, number):
+	"""Машина водителя из чёрного списка: один раз на пару телефон - номер"""
+	return f'{PHONE_MATCH_PREFIX}{phone}~{number}'
+
+
+def shared_driver_key(phone):
+	"""Водитель в нескольких такси: один раз на телефон"""
+	return f'{SHARED_DRIVER_PREFIX}{phone}'
+
 
 class Database:
 	def __init__(self, db_name='processed_cars.db'):
@@ -8,9 +40,14 @@ class Database:
 		self.conn = self.create_connection()
 		self.cursor = self.conn.cursor()
 		self.create_table()
+		self.processed = self.load_processed()	# Множество (taxi, carnum) уже отправленных уведомлений
 
 	def create_connection(self):
-		return sqlite3.connect(self.db_name)
+		# Подключение используется и потоком рассылки (outbox), доступ через self.lock
+		conn = sqlite3.connect(self.db_name, check_same_thread=False)
+		conn.execute('PRAGMA journal_mode=WAL')
+		conn.execute('PRAGMA synchronous=NORMAL')
+		return conn
 
 	def create_table(self):
 		try:
@@ -22,6 +59,73 @@ class Database:
 				);
 			'''
 			self.cursor.execute(create_table_query)
+			# Перед созданием уникального индекса убираем старые дубликаты
+			self.cursor.execute('''
+				DELETE FROM processed_cars WHERE id NOT IN (
+					SELECT MIN(id) FROM processed_cars GROUP BY taxi, carnum
+				);
+			''')
+			self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS processed_cars_taxi_carnum ON processed_cars (taxi, carnum)")
+			# Последний проверенный снимок чёрного списка
+			self.cursor.execute('''
+				CREATE TABLE IF NOT EXISTS blacklist_snapshot (
+					carnum TEXT PRIMARY KEY,
+					reason TEXT
+				);
+			''')
+			# Служебные значения (хэш снимка, время полной проверки и т.п.)
+			self.cursor.execute('''
+				CREATE TABLE IF NOT EXISTS meta (
+					key TEXT PRIMARY KEY,
+					value TEXT
+				);
+			''')
+			# Очередь уведомлений Telegram (рассылается фоновым потоком)
+			self.cursor.execute('''
+				CREATE TABLE IF NOT EXISTS outbox (
+					id INTEGER PRIMARY KEY AUTOINCREMENT,
+					chat_id INTEGER NOT NULL,
+					text TEXT NOT NULL,
+					created_at REAL NOT NULL,
+					next_attempt_at REAL NOT NULL,
+					attempts INTEGER NOT NULL DEFAULT 0
+				);
+			''')
+			self.cursor.execute("CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt_at)")
+			# Кэш ответов baza-gai.com.ua (data = NULL - сайт не знает номер)
+			self.cursor.execute('''
+				CREATE TABLE IF NOT EXISTS police_cache (
+					plate TEXT PRIMARY KEY,
+					data TEXT,
+					fetched_at REAL NOT NULL
+				);
+			''')
+			# Последний снимок автопарка каждого такси (для поиска по номеру и телефону без Firebird)
+			self.cursor.execute('''
+				CREATE TABLE IF NOT EXISTS fleet_snapshot (
+					taxi TEXT NOT NULL,
+					plate_key TEXT NOT NULL,
+					signal, number, marka, year, color, open_time, balans, f, i, o, phone3, phone2, phone1
+				);
+			''')
+			self.cursor.execute("CREATE INDEX IF NOT EXISTS fleet_snapshot_plate ON fleet_snapshot (plate_key)")
+			# Нормализованные телефоны водителей из снимков автопарков
+			self.cursor.execute('''
+				CREATE TABLE IF NOT EXISTS fleet_phones (
+					phone TEXT NOT NULL,
+					taxi TEXT NOT NULL,
+					plate_key TEXT NOT NULL
+				);
+			''')
+			self.cursor.execute("CREATE INDEX IF NOT EXISTS fleet_phones_phone ON fleet_phones (phone)")
+			# Телефоны водителей машин из чёрного списка (для поиска их других машин)
+			self.cursor.execute('''
+				CREATE TABLE IF NOT EXISTS blacklist_phones (
+					phone TEXT PRIMARY KEY,
+					carnum TEXT NOT NULL,
+					reason TEXT
+				);
+			''')
 			self.conn.commit()
 			print("Table created successfully")
 		except sqlite3.Error as e:
@@ -36,41 +140,259 @@ class Database:
 			print(f"Error connecting to database: {e}")
 
 
-	def insert_record(self, taxi, carnum):
+	def load_processed(self):
+		"""Загружает все обработанные пары (taxi, carnum) в память"""
 		try:
-			insert_query = "INSERT INTO processed_cars (taxi, carnum) VALUES (?, ?)"
-			self.cursor.execute(insert_query, (taxi, carnum))
-			self.conn.commit()
-			# print("Record inserted successfully")
+			with self.lock:
+				rows = self.conn.execute("SELECT taxi, carnum FROM processed_cars").fetchall()
+			return {(str(taxi), carnum) for taxi, carnum in rows}
 		except sqlite3.Error as e:
-			print(f"Error inserting record: {e}")
+			print(f"Error loading processed records: {e}")
+			return set()
+
+	def save_notifications(self, records, messages):
+		"""Отмечает записи обработанными и ставит уведомления в очередь outbox одной транзакцией.
+
+		records - (taxi, carnum), messages - (chat_id, text). Ошибка SQLite
+		пробрасывается: записи не отмечаются, и в следующем цикле машины будут
+		найдены и уведомления поставлены в очередь снова.
+		"""
+		records = [(str(taxi), carnum) for taxi, carnum in records]
+		if not records and not messages:
+			return
+		now = time.time()
+		try:
+			with self.lock:
+				with self.conn:
+					self.conn.executemany(
+						"INSERT OR IGNORE INTO processed_cars (taxi, carnum) VALUES (?, ?)", records
+					)
+					self.conn.executemany(
+						"INSERT INTO outbox (chat_id, text, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+						((chat_id, text, now, now) for chat_id, text in messages)
+					)
+				self.processed.update(records)
+		except sqlite3.Error as e:
+			logger.error(f'Error saving notifications: {e}')
+			raise
 
 	def check_record(self, carnum, taxi):
+		return (str(taxi), carnum) in self.processed
+
+	def get_meta(self, key, default=None):
 		try:
-			connection = sqlite3.connect(self.db_name)
-			cursor = connection.cursor()
+			with self.lock:
+				row = self.conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+			return row[0] if row else default
+		except sqlite3.Error as e:
+			print(f"Error reading meta {key}: {e}")
+			return default
 
-			check_query = "SELECT * FROM processed_cars WHERE carnum=? AND taxi=?"
-			self.lock.acquire()  # Блокировка мьютекса
+	def set_meta(self, key, value):
+		"""Сохраняет служебное значение; ошибка SQLite пробрасывается вызывающему"""
+		try:
+			with self.lock, self.conn:
+				self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+		except sqlite3.Error as e:
+			logger.error(f'Error writing meta {key}: {e}')
+			raise
 
-			cursor.execute(check_query, (carnum, taxi))
-			existing_record = cursor.fetchone()
+	def load_blacklist_snapshot(self):
+		try:
+			with self.lock:
+				return dict(self.conn.execute("SELECT carnum, reason FROM blacklist_snapshot").fetchall())
+		except sqlite3.Error as e:
+			print(f"Error loading blacklist snapshot: {e}")
+			return {}
 
-			if existing_record:
-				# print(f"Record for carnum {carnum} and taxi {taxi} exists in the database.")
-				return True
-			else:
-				# print(f"No record found for carnum {carnum} and taxi {taxi}.")
-				return False
+	def save_blacklist_snapshot(self, black_list, content_hash):
+		"""Заменяет снимок чёрного списка и его хэш одной транзакцией.
 
+		Ошибка SQLite пробрасывается: иначе хэш не сохранится и каждый следующий
+		цикл будет молча сравнивать весь список заново.
+		"""
+		try:
+			with self.lock, self.conn:
+				self.conn.execute("DELETE FROM blacklist_snapshot")
+				self.conn.executemany(
+					"INSERT INTO blacklist_snapshot (carnum, reason) VALUES (?, ?)",
+					black_list.items()
+				)
+				self.conn.execute(
+					"INSERT OR REPLACE INTO meta (key, value) VALUES ('blacklist_hash', ?)",
+					(content_hash,)
+				)
 		except sqlite3.Error as e:
-			print(f"Error checking record: {e}")
+			logger.error(f'Error saving blacklist snapshot: {e}')
+			raise
 
-		finally:
-			self.lock.release()  # Разблокировка мьютекса после выполнения запроса
-			connection.close()  # Закрытие соединения с базой данных
+	def find_blacklist_reason(self, plates):
+		"""(номер, причина) из снимка чёрного списка для любого из написаний номера или None"""
+		plates = list(plates)
+		try:
+			with self.lock:
+				return self.conn.execute(
+					f"SELECT carnum, reason FROM blacklist_snapshot WHERE carnum IN ({','.join('?' * len(plates))})", plates
+				).fetchone()
+		except sqlite3.Error as e:
+			print(f"Error reading blacklist snapshot: {e}")
+			return None
 
+	def load_blacklist_phones(self):
+		"""{телефон: (номер из чёрного списка, причина)}"""
+		try:
+			with self.lock:
+				return {phone: (carnum, reason) for phone, carnum, reason in self.conn.execute("SELECT phone, carnum, reason FROM blacklist_phones")}
+		except sqlite3.Error as e:
+			print(f"Error loading blacklist phones: {e}")
+			return {}
 
+	def save_blacklist_phones(self, phones):
+		"""Добавляет или обновляет телефоны {телефон: (номер, причина)}"""
+		try:
+			with self.lock, self.conn:
+				self.conn.executemany(
+					"INSERT OR REPLACE INTO blacklist_phones (phone, carnum, reason) VALUES (?, ?, ?)",
+					((phone, carnum, reason) for phone, (carnum, reason) in phones.items())
+				)
+		except sqlite3.Error as e:
+			print(f"Error saving blacklist phones: {e}")
+
+	def save_fleet_snapshot(self, taxi, rows, phones, content_hash):
+		"""Заменяет снимок автопарка такси, его телефоны и хэш одной транзакцией.
+
+		rows - (plate_key, signal, number, ..., phone1), phones - (телефон, plate_key).
+		"""
+		taxi = str(taxi)
+		try:
+			with self.lock, self.conn:
+				self.conn.execute("DELETE FROM fleet_snapshot WHERE taxi=?", (taxi,))
+				self.conn.execute("DELETE FROM fleet_phones WHERE taxi=?", (taxi,))
+				self.conn.executemany(
+					"INSERT INTO fleet_snapshot VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+					((taxi,) + row for row in rows)
+				)
+				self.conn.executemany(
+					"INSERT INTO fleet_phones (phone, taxi, plate_key) VALUES (?, ?, ?)",
+					((phone, taxi, plate_key) for phone, plate_key in phones)
+				)
+				self.conn.executemany(
+					"INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+					[(f'fleet_hash:{taxi}', content_hash), (f'fleet_updated:{taxi}', str(time.time()))]
+				)
+		except sqlite3.Error as e:
+			print(f"Error saving fleet snapshot for {taxi}: {e}")
+
+	def find_fleet_by_plate(self, plate_key):
+		"""Машины с каноническим номером plate_key во всех снимках: [(taxi, signal, number, ..., phone1)]"""
+		try:
+			with self.lock:
+				return self.conn.execute(
+					"SELECT taxi, signal, number, marka, year, color, open_time, balans, f, i, o, phone3, phone2, phone1 "
+					"FROM fleet_snapshot WHERE plate_key=? ORDER BY taxi", (plate_key,)
+				).fetchall()
+		except sqlite3.Error as e:
+			print(f"Error reading fleet snapshot: {e}")
+			return []
+
+	def find_fleet_by_phone(self, phone):
+		"""Машины водителей с нормализованным телефоном phone во всех снимках"""
+		try:
+			with self.lock:
+				return self.conn.execute(
+					"SELECT DISTINCT s.taxi, s.signal, s.number, s.marka, s.year, s.color, s.open_time, s.balans, s.f, s.i, s.o, s.phone3, s.phone2, s.phone1 "
+					"FROM fleet_phones p JOIN fleet_snapshot s ON s.plate_key = p.plate_key AND s.taxi = p.taxi "
+					"WHERE p.phone=? ORDER BY s.taxi", (phone,)
+				).fetchall()
+		except sqlite3.Error as e:
+			print(f"Error reading fleet snapshot: {e}")
+			return []
+
+	def get_due_messages(self, limit=500):
+		"""Сообщения, время отправки которых наступило, в порядке постановки в очередь"""
+		try:
+			with self.lock:
+				return self.conn.execute(
+					"SELECT id, chat_id, text, attempts FROM outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT ?",
+					(time.time(), limit)
+				).fetchall()
+		except sqlite3.Error as e:
+			print(f"Error reading outbox: {e}")
+			return []
+
+	def get_next_attempt_time(self):
+		"""Ближайшее время отправки среди отложенных (ещё не наступивших) сообщений или None"""
+		try:
+			with self.lock:
+				return self.conn.execute(
+					"SELECT MIN(next_attempt_at) FROM outbox WHERE next_attempt_at > ?", (time.time(),)
+				).fetchone()[0]
+		except sqlite3.Error as e:
+			print(f"Error reading outbox: {e}")
+			return None
+
+	def count_messages(self):
+		"""Количество сообщений в очереди outbox"""
+		try:
+			with self.lock:
+				return self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+		except sqlite3.Error as e:
+			print(f"Error reading outbox: {e}")
+			return 0
+
+	def delete_message(self, message_id):
+		try:
+			with self.lock, self.conn:
+				self.conn.execute("DELETE FROM outbox WHERE id=?", (message_id,))
+		except sqlite3.Error as e:
+			print(f"Error deleting message {message_id}: {e}")
+
+	def reschedule_message(self, message_id, next_attempt_at, attempts):
+		try:
+			with self.lock, self.conn:
+				self.conn.execute(
+					"UPDATE outbox SET next_attempt_at=?, attempts=? WHERE id=?",
+					(next_attempt_at, attempts, message_id)
+				)
+		except sqlite3.Error as e:
+			print(f"Error rescheduling message {message_id}: {e}")
+
+	def get_police_cache(self, plate):
+		"""Возвращает (data, fetched_at) из кэша baza-gai или None"""
+		try:
+			with self.lock:
+				return self.conn.execute(
+					"SELECT data, fetched_at FROM police_cache WHERE plate=?", (plate,)
+				).fetchone()
+		except sqlite3.Error as e:
+			print(f"Error reading police cache: {e}")
+			return None
+
+	def get_police_cache_many(self, plates, chunk_size=500):
+		"""{номер: (data, fetched_at)} из кэша baza-gai для пачки номеров"""
+		plates = list(plates)
+		found = {}
+		try:
+			with self.lock:
+				for start in range(0, len(plates), chunk_size):
+					chunk = plates[start:start + chunk_size]
+					rows = self.conn.execute(
+						f"SELECT plate, data, fetched_at FROM police_cache WHERE plate IN ({','.join('?' * len(chunk))})", chunk
+					)
+					found.update((plate, (data, fetched_at)) for plate, data, fetched_at in rows)
+		except sqlite3.Error as e:
+			print(f"Error reading police cache: {e}")
+		return found
+
+	def set_police_cache(self, plate, data):
+		try:
+			with self.lock, self.conn:
+				self.conn.execute(
+					"INSERT OR REPLACE INTO police_cache (plate, data, fetched_at) VALUES (?, ?, ?)",
+					(plate, data, time.time())
+				)
+		except sqlite3.Error as e:
+			print(f"Error writing police cache: {e}")
 
 	def close_connection(self):
 		if self.conn:
@@ -80,7 +402,7 @@ class Database:
 # Пример использования:
 # db = Database()
 # db.create_table()
-# db.insert_record("Taxi1", "Signal1", "12345", "Reason1", "OtherTaxi1", 1)
+# db.save_notifications([("Taxi1", "12345")], [])
 # db.check_record("12345")
 # db.close_connection()
 if __name__ == '__main__':
@@ -91,8 +413,10 @@ if __name__ == '__main__':
 	fly =  'Fly', ['AA8732CC', 'AA0158HB', 'AI8991BT', '83923OK']
 	magdack = 'Magdack', ['AA8732CC', 'AA3944EM', 'AH0334BM', 'KA9810HX', 'TEST', 'AA2956CH', 'AA8144TO', 'AA2203HE', 'CB9019EA', 'AI8991BT', 'AA2497CA', 'AA0429HH', 'AA6214XH', ]
 	taxi898 = 898, ['KA2751IP1','KA2751IP', 'AH0334BM', 'KA9810HX', 'AI8067AC', 'AA8144TO', 'AA9282KI', 'AA5344IIK', 'BC5637BO', 'AA7477XH', 'AA8389EE', 'KAA6799IH', 'AA0429HH', 'KA2927IM', ]
+	records = []
 	for taxi, cars in [jet, allo, fly, magdack, taxi898]:
 		for car in cars:
 			if not db.check_record(car, taxi):
-				db.insert_record(taxi, car)
-				print(taxi, car)
\ No newline at end of file
+				records.append((taxi, car))
+				print(taxi, car)
+	db.save_notifications(records, [])
\ No newline at end of file
@@ -0,0 +1,146 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from time import monotonic
+
+from loguru import logger
+
+import utils
+
+WD_GROUPS_URL = f'{utils.WD_BASE_URL}/TaxiGroup/SelectByGroup'
+WD_ORDERS_URL = f'{utils.WD_BASE_URL}/Order/SearchData'
+GROUP_CACHE_TTL = float(os.getenv('GROUP_CACHE_TTL_MINUTES', '1440')) * 60		# Срок жизни списка служб сервера, сек
+STATS_WORKERS = int(os.getenv('STATS_WORKERS', '5'))								# Одновременных запросов статистики
+STATS_PERIOD_DAYS = 30
+STATS_ROWS = 10000
+
+
+class GroupCache:
+	"""Списки служб серверов WD (id -> название) с TTL"""
+
+	def __init__(self, ttl=GROUP_CACHE_TTL):
+		self.ttl = ttl
+		self.groups = {}						# server_id -> (monotonic, {id: название})
+		self.locks = {}
+		self.lock = threading.Lock()
+
+	def get(self, session, server_id):
+		"""Список служб сервера; загружается один раз на TTL, даже из нескольких потоков"""
+		with self.lock:
+			server_lock = self.locks.setdefault(server_id, threading.Lock())
+		with server_lock:
+			cached = self.groups.get(server_id)
+			if cached and monotonic() - cached[0] < self.ttl:
+				return cached[1]
+			response = utils.make_request('GET', WD_GROUPS_URL, session, params={'group': server_id})
+			if response is None or response.status_code >= 400:
+				# Устаревший список лучше, чем никакого
+				return cached[1] if cached else None
+			groups = response.json()
+			self.groups[server_id] = (monotonic(), groups)
+			return groups
+
+	def find_id(self, session, server_id, taxi_name):
+		"""Айди службы taxi_name в списке служб сервера"""
+		groups = self.get(session, server_id)
+		if not groups:
+			return None
+		for id in groups:
+			if taxi_name in groups[id]:
+				return id
+		return None
+
+	def clear(self):
+		with self.lock:
+			self.groups.clear()
+
+
+group_cache = GroupCache()
+
+
+def normalize_servers(servers):
+	"""Сервера WD как dict {название: id} (допускается и список пар)"""
+	if isinstance(servers, dict):
+		return servers
+	if isinstance(servers, list):
+		return dict(servers)
+	return None
+
+
+def fetch_orders(session, server_id, taxi_id, car_num, period):
+	"""Заказы машины car_num за период, принятые от службы taxi_id; строки jqGrid или None"""
+	data = {'group': server_id, '_search': 'true', 'rows': STATS_ROWS, 'page': 1, 'sidx': 'ReqStartTime', 'ReqStartTime': period, 'TaxiIdFrom': taxi_id, 'CarNo': car_num}
+	response = utils.make_request('GET', WD_ORDERS_URL, session, data=data)
+	if response is None:
+		return None
+	result = response.json()
+	if int(result['total']) > 0:
+		return result['rows']
+	return []
+
+
+def summarize(rows, taxi_name, servers):
+	"""(позывной, 'фирмы через запятую') по строкам заказов или None, если машина не наша"""
+	work_in_taxi = set()
+	pozivnoi = None
+	for row in rows:
+		taxi_from_car = row['cell'][11]
+		work_in_taxi.add(taxi_from_car)
+		if taxi_name in taxi_from_car:
+			pozivnoi = row['cell'][14]
+	if not pozivnoi:
+		return None
+	firms = set()
+	for val in work_in_taxi:
+		for server in servers:
+			val = val.replace(' ' + server, '')
+		firms.add(val)
+	return pozivnoi, ', '.join(firms)
+
+
+def get_batch_statistics(session, servers, plates, taxi_name):
+	"""Статистика WD для пачки номеров: {номер: (позывной, фирмы)}.
+
+	Айди службы на каждом сервере берётся из group_cache. Order/SearchData
+	фильтрует только по одному номеру (CarNo), поэтому на каждую пару
+	(сервер, номер) уходит отдельный запрос. Запросы ставятся в очередь
+	параллельно, но темп к WD ограничивает token bucket в utils.make_request:
+	пачка из N номеров на S серверах занимает около N * S / RATE_LIMITS[WD]
+	секунд (20 номеров на одном сервере при 0.5 запроса/с - около 40 с).
+	"""
+	server_list = normalize_servers(servers)
+	plates = list(plates)
+	if server_list is None or not plates:
+		return {}
+
+	finish = datetime.now().strftime('%d.%m.%Y')
+	start = (datetime.now() - timedelta(days=STATS_PERIOD_DAYS)).strftime('%d.%m.%Y')
+	period = f"{start}+-+{finish}"
+
+	with ThreadPoolExecutor(max_workers=STATS_WORKERS, thread_name_prefix='stats') as executor:
+		taxi_ids = dict(zip(server_list.values(), executor.map(
+			lambda server_id: group_cache.find_id(session, server_id, taxi_name), server_list.values()
+		)))
+		futures = {
+			(server_id, car_num): executor.submit(fetch_orders, session, server_id, taxi_ids[server_id], car_num, period)
+			for server_id in server_list.values()
+			for car_num in plates
+		}
+
+	rows = {car_num: [] for car_num in plates}
+	for (server_id, car_num), future in futures.items():
+		try:
+			result = future.result()
+		except Exception as EX:
+			logger.warning(f'Driver statistics for {car_num} on server {server_id} failed: {EX!r}')
+			continue
+		if result:
+			rows[car_num].extend(result)
+
+	statistics = {}
+	for car_num in plates:
+		summary = summarize(rows[car_num], taxi_name, server_list)
+		if summary:
+			statistics[car_num] = summary
+	return statistics
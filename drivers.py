@@ -0,0 +1,78 @@
+import threading
+from collections import defaultdict
+
+import fleet
+
+MESSAGE_LIMIT = 4000			# Длина одного сообщения сводки (лимит Telegram 4096)
+
+
+class DriverIndex:
+	"""Нормализованный телефон водителя -> машины во всех автопарках цикла.
+
+	Строится из индексов телефонов автопарков (fleet.Fleet.phone_index, по всем
+	строкам, включая водителей-сменщиков): машины с одинаковым телефоном
+	попадают в один список, поэтому совпадения ищутся без попарного сравнения
+	водителей.
+	"""
+
+	def __init__(self):
+		self.cars = defaultdict(list)		# телефон -> [(taxi, номер, позывной)]
+		self.blocked = {}					# телефон -> (номер из чёрного списка, причина)
+		self.taxis = {}						# taxi -> (название, chat_id)
+		self.lock = threading.Lock()		# asyncio-режим добавляет автопарки из пула потоков
+
+	def add_fleet(self, taxi, taxi_name, chat_id, cars, black_list, plate_index):
+		"""Добавляет автопарк; телефоны машин из чёрного списка запоминаются как заблокированные"""
+		with self.lock:
+			self.taxis[taxi] = (taxi_name, chat_id)
+			blocked_numbers = {}			# номер автопарка -> номер из чёрного списка или None
+			for phone, numbers in cars.phone_index().items():
+				for number, signal in numbers:
+					self.cars[phone].append((taxi, number, signal))
+					if number not in blocked_numbers:
+						blocked_numbers[number] = plate_index.get(fleet.normalize_plate(number))
+					carnum = blocked_numbers[number]
+					if carnum is not None:
+						self.blocked.setdefault(phone, (carnum, black_list[carnum]))
+
+	def phone_matches(self, blocked):
+		"""(телефон, номер из чёрного списка, причина, taxi, номер, позывной) для машин
+		с телефоном заблокированного водителя, но с другим номером"""
+		for phone, (carnum, reason) in blocked.items():
+			key = fleet.normalize_plate(carnum)
+			for taxi, number, signal in self.cars.get(phone, ()):
+				if fleet.normalize_plate(number) != key:
+					yield phone, carnum, reason, taxi, number, signal
+
+	def shared_drivers(self):
+		"""(телефон, [(taxi, номер, позывной)]) для водителей, которые есть в нескольких такси"""
+		for phone, cars in self.cars.items():
+			if len({taxi for taxi, number, signal in cars}) > 1:
+				yield phone, cars
+
+
+def render_phone_match(phone, carnum, reason, number, signal):
+	""" Текст уведомления о машине водителя из чёрного списка """
+	return (
+		f'📞 Телефон водителя из чёрного списка: {number}, позывной {signal}\n\n'
+		f'Телефон {phone} указан и у машины {carnum} из чёрного списка\n\n'
+		f'Причина блокировки - {reason}'
+	)
+
+
+def render_shared_driver(phone, cars, taxis):
+	""" Строка сводки: телефон и машины водителя во всех такси """
+	return f'{phone}: ' + '; '.join(f'{taxis[taxi][0]} - {number} (позывной {signal})' for taxi, number, signal in cars)
+
+
+def render_shared_drivers(lines):
+	""" Сводка о водителях, работающих в нескольких такси, разбитая на сообщения """
+	messages = []
+	text = '👥 Водители, которые работают и в других наших такси:\n'
+	for line in lines:
+		if len(text) + len(line) + 2 > MESSAGE_LIMIT:
+			messages.append(text)
+			text = '👥 (продолжение)\n'
+		text += '\n' + line
+	messages.append(text)
+	return messages
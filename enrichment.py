@@ -0,0 +1,91 @@
+"""Подготовка уведомлений о найденных машинах.
+
+Здесь нет запросов к сети и базам: данные машин, ответы baza-gai и
+статистика WD передаются готовыми, поэтому тексты всех находок такси
+собираются одной пачкой и этот этап можно проверять и замерять отдельно.
+"""
+import re
+from datetime import date
+from string import Template
+
+from loguru import logger
+
+import fleet
+
+OPEN_TIME = re.compile(r'(\d{4}-\d{2}-\d{2}) \d{2}:\d{2}:\d{2}\.\d{1,6}')
+
+MESSAGE = Template('$carnum - позывной: $signal, марка:  $marka, год: $year, цвет: $color\n\n$contacts\n\nПо данным сайта baza-gai.com.ua: $police$stats\n\nПричина блокировки - $reason')
+POSSIBLE_MATCH = Template('⚠️ Возможное совпадение: в чёрном списке $carnum, в базе такси $fleet_plate (отличие в один символ)\n\n$message')
+NO_POLICE_DATA = Template('отсутствуют данные по номеру $carnum')
+STATS = Template('\n\nПо данным WD: позывной $pozivnoi, работает в: $firms')
+
+
+def format_phone(phone):
+	"""Телефон для уведомления: 0XXXXXXXXX, а если номер не украинский - только его цифры"""
+	if not phone:
+		return ''
+	return fleet.normalize_phone(phone) or fleet.NON_DIGITS.sub('', str(phone))
+
+
+def format_open_time(open_time):
+	"""Дата из Open_Time ('2024-01-31 10:00:00.000' или datetime); другое значение - как есть"""
+	if isinstance(open_time, date):
+		return open_time.strftime('%Y-%m-%d')
+	open_time = str(open_time)
+	match = OPEN_TIME.fullmatch(open_time)
+	return match.group(1) if match else open_time
+
+
+def render_contacts(carnum, record):
+	"""Водитель, телефоны без повторов, баланс, дата в программе и номер в базе такси"""
+	lines = [''.join(f'{part} ' for part in (record.f, record.i, record.o) if part)]
+	phones = []
+	for phone in (record.phone1, record.phone2, record.phone3):
+		phone = format_phone(phone)
+		if phone and phone not in phones:
+			phones.append(phone)
+	lines += phones
+	lines.append(f'Баланс: {round(record.balans, 2)}')
+	if record.open_time:
+		lines.append(f'Был в программе: {format_open_time(record.open_time)}')
+	if record.number and record.number != carnum:
+		lines.append(f'Номер в базе такси: {record.number}')
+	return '\n'.join(lines)
+
+
+def render_message(carnum, record, police_info, reason, stats=None):
+	"""Текст уведомления о машине из чёрного списка"""
+	return MESSAGE.substitute(
+		carnum=carnum, signal=record.signal, marka=record.marka, year=record.year, color=record.color,
+		contacts=render_contacts(carnum, record),
+		police=police_info or NO_POLICE_DATA.substitute(carnum=carnum),
+		stats=STATS.substitute(pozivnoi=stats[0], firms=stats[1]) if stats else '',
+		reason=reason,
+	)
+
+
+def render_possible_match(carnum, fleet_plate, record, police_info, reason):
+	"""Текст уведомления о номере, отличающемся от номера из чёрного списка одной опечаткой"""
+	return POSSIBLE_MATCH.substitute(carnum=carnum, fleet_plate=fleet_plate, message=render_message(carnum, record, police_info, reason))
+
+
+def render_hits(hits, cars, black_list, police_infos, statistics):
+	"""[(номер, текст)] для всех находок такси; police_infos - {номер: данные baza-gai}"""
+	messages = []
+	for carnum in hits:
+		try:
+			messages.append((carnum, render_message(carnum, cars[carnum], police_infos.get(carnum), black_list[carnum], statistics.get(carnum))))
+		except Exception as EX:
+			logger.exception(f'Could not render notification for {carnum}: {EX}')
+	return messages
+
+
+def render_near_misses(near_misses, cars, black_list, police_infos):
+	"""[((номер из чёрного списка, номер в автопарке), текст)] для возможных совпадений"""
+	messages = []
+	for carnum, fleet_plate in near_misses:
+		try:
+			messages.append(((carnum, fleet_plate), render_possible_match(carnum, fleet_plate, cars[fleet_plate], police_infos.get(fleet_plate), black_list[carnum])))
+		except Exception as EX:
+			logger.exception(f'Could not render notification for {carnum} ~ {fleet_plate}: {EX}')
+	return messages
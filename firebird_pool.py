@@ -0,0 +1,150 @@
+import os
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+import firebirdsql as fdb
+from loguru import logger
+
+# ===== НАСТРОЙКИ ПОДКЛЮЧЕНИЯ К FIREBIRD =====
+FIREBIRD_USER = os.getenv('FIREBIRD_USER', 'SYSDBA')
+FIREBIRD_PASSWORD = os.getenv('FIREBIRD_PASSWORD', 'masterkey')
+FIREBIRD_TIMEOUT = float(os.getenv('FIREBIRD_TIMEOUT', '60'))				# Таймаут подключения и сетевых операций, сек
+FIREBIRD_VALIDATE_IDLE = float(os.getenv('FIREBIRD_VALIDATE_IDLE', '30'))	# Проверять подключение, если оно простаивало дольше, сек
+FIREBIRD_BACKOFF_BASE = float(os.getenv('FIREBIRD_BACKOFF_BASE', '30'))		# Первая пауза перед повторным подключением, сек
+FIREBIRD_BACKOFF_MAX = float(os.getenv('FIREBIRD_BACKOFF_MAX', '900'))		# Максимальная пауза перед повторным подключением, сек
+
+VALIDATION_SQL = 'SELECT 1 FROM RDB$DATABASE'
+
+
+class FirebirdUnavailable(fdb.OperationalError):
+	"""База такси недоступна (ошибка подключения, пауза перед переподключением или занята)"""
+
+
+def connect_firebird(host, database):
+	"""Открывает новое подключение к Firebird с таймаутом"""
+	return fdb.connect(
+		host=host,
+		database=database,
+		user=FIREBIRD_USER,
+		password=FIREBIRD_PASSWORD,
+		charset='UTF8',
+		timeout=FIREBIRD_TIMEOUT,
+	)
+
+
+class FirebirdConnection:
+	"""Постоянное подключение к базе одного такси с проверкой и переподключением"""
+
+	def __init__(self, host, database, name, connect=connect_firebird, validation_sql=VALIDATION_SQL):
+		self.host = host
+		self.database = database
+		self.name = name
+		self.connect = connect
+		self.validation_sql = validation_sql
+		self.lock = threading.Lock()
+		self.conn = None
+		self.last_used = 0.0
+		self.failures = 0
+		self.next_attempt = 0.0
+
+	def _close(self):
+		if self.conn is not None:
+			try:
+				self.conn.close()
+			except Exception as EX:
+				logger.debug(f'Error closing Firebird connection to {self.name}: {EX}')
+			self.conn = None
+
+	def _is_alive(self):
+		"""Проверяет подключение простым запросом"""
+		try:
+			cur = self.conn.cursor()
+			cur.execute(self.validation_sql)
+			cur.fetchall()
+			cur.close()
+			self.conn.commit()
+			return True
+		except Exception as EX:
+			logger.warning(f'Firebird connection to {self.name} is stale, reconnecting: {EX}')
+			return False
+
+	def _open(self):
+		"""Открывает подключение с учётом экспоненциальной паузы после ошибок"""
+		now = monotonic()
+		if now < self.next_attempt:
+			raise FirebirdUnavailable(
+				f'{self.name} ({self.host}) is in reconnect backoff for another {self.next_attempt - now:.0f}s'
+			)
+		try:
+			self.conn = self.connect(self.host, self.database)
+		except Exception as EX:
+			self.failures += 1
+			delay = min(FIREBIRD_BACKOFF_BASE * 2 ** (self.failures - 1), FIREBIRD_BACKOFF_MAX)
+			self.next_attempt = monotonic() + delay
+			logger.warning(f'Failed to connect to {self.name} ({self.host}), next attempt in {delay:.0f}s: {EX}')
+			if isinstance(EX, fdb.Error):
+				raise
+			raise FirebirdUnavailable(f'Connection to {self.name} ({self.host}) failed: {EX}') from EX
+		self.failures = 0
+		self.next_attempt = 0.0
+		logger.info(f'Connected to Firebird {self.name} ({self.host})')
+
+	@contextmanager
+	def acquire(self):
+		"""Выдаёт проверенное подключение; после работы закрывает транзакцию.
+
+		Транзакция завершается после каждого использования, иначе следующий
+		цикл читал бы старый снимок данных. При ошибке подключение сбрасывается.
+		"""
+		if not self.lock.acquire(timeout=FIREBIRD_TIMEOUT):
+			raise FirebirdUnavailable(f'Previous query to {self.name} ({self.host}) is still running')
+		try:
+			if self.conn is not None and monotonic() - self.last_used > FIREBIRD_VALIDATE_IDLE:
+				if not self._is_alive():
+					self._close()
+			if self.conn is None:
+				self._open()
+			try:
+				yield self.conn
+				self.conn.commit()
+			except Exception:
+				self._close()
+				raise
+			finally:
+				self.last_used = monotonic()
+		finally:
+			self.lock.release()
+
+	def close(self):
+		with self.lock:
+			self._close()
+
+
+class FirebirdPool:
+	"""Набор постоянных подключений, по одному на базу такси"""
+
+	def __init__(self, connect=connect_firebird, validation_sql=VALIDATION_SQL):
+		self.connect = connect
+		self.validation_sql = validation_sql			# Для других СУБД (например, SQLite в бенчмарке) - 'SELECT 1'
+		self.lock = threading.Lock()
+		self.connections = {}
+
+	def get(self, host, database, name='Unknown'):
+		key = (host, database)
+		with self.lock:
+			if key not in self.connections:
+				self.connections[key] = FirebirdConnection(host, database, name, self.connect, self.validation_sql)
+			return self.connections[key]
+
+	def acquire(self, host, database, name='Unknown'):
+		return self.get(host, database, name).acquire()
+
+	def close_all(self):
+		with self.lock:
+			connections = list(self.connections.values())
+		for connection in connections:
+			connection.close()
+
+
+pool = FirebirdPool()
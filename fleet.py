@@ -0,0 +1,256 @@
+import os
+import re
+
+FLEET_FETCH_SIZE = int(os.getenv('FLEET_FETCH_SIZE', '1000'))		# Строк за один fetchmany из Firebird
+
+# Кириллические буквы номеров, которые пишут вместо латинских двойников (и наоборот)
+CYRILLIC_LETTERS = 'АВЕІКМНОРСТХУ'
+LATIN_LETTERS = 'ABEIKMHOPCTXY'
+TO_LATIN = str.maketrans(CYRILLIC_LETTERS, LATIN_LETTERS)
+TO_CYRILLIC = str.maketrans(LATIN_LETTERS, CYRILLIC_LETTERS)
+PLATE_SEPARATORS = re.compile(r'[\s\-]+')
+NON_DIGITS = re.compile(r'\D')
+
+
+def normalize_plate(plate):
+	"""Канонический вид номера: без пробелов и дефисов, верхний регистр, латиница"""
+	if plate is None:
+		return ''
+	return PLATE_SEPARATORS.sub('', str(plate)).upper().translate(TO_LATIN)
+
+
+def plate_variants(plate):
+	"""Написания номера для запроса в Firebird: как есть, латиницей и кириллицей"""
+	key = normalize_plate(plate)
+	return {plate, key, key.translate(TO_CYRILLIC)}
+
+
+def normalize_phone(phone):
+	"""Канонический вид телефона: 0XXXXXXXXX, или '' если это не украинский номер"""
+	if not phone:
+		return ''
+	digits = NON_DIGITS.sub('', str(phone))
+	if len(digits) == 12 and digits.startswith('380'):
+		return digits[2:]
+	if len(digits) == 11 and digits.startswith('80'):
+		return digits[1:]
+	if len(digits) == 10 and digits.startswith('0'):
+		return digits
+	if len(digits) == 9:
+		return '0' + digits
+	return ''
+
+
+class PlateIndex(dict):
+	"""Канонический номер -> номер как в источнике; строится один раз на снимок"""
+
+	def __init__(self, plates=()):
+		super().__init__()
+		for plate in plates:
+			self.add(plate)
+
+	def add(self, plate):
+		self.setdefault(normalize_plate(plate), plate)
+
+
+def deletions(key):
+	"""Ключ и все его варианты без одного символа"""
+	return {key} | {key[:pos] + key[pos + 1:] for pos in range(len(key))}
+
+
+def within_one_typo(a, b):
+	"""a и b отличаются одной заменой, вставкой, удалением или перестановкой соседних символов"""
+	if a == b or abs(len(a) - len(b)) > 1:
+		return False
+	if len(a) > len(b):
+		a, b = b, a
+	start = 0
+	while start < len(a) and a[start] == b[start]:
+		start += 1
+	if len(a) < len(b):
+		return a[start:] == b[start + 1:]
+	if a[start + 1:] == b[start + 1:]:
+		return True
+	return (
+		start + 1 < len(a)
+		and a[start] == b[start + 1] and a[start + 1] == b[start]
+		and a[start + 2:] == b[start + 2:]
+	)
+
+
+class NearMissIndex:
+	"""Индекс симметричных удалений для поиска номеров с одной опечаткой.
+
+	Для каждого ключа хранятся все его варианты без одного символа; два номера
+	на расстоянии одной правки обязательно делят хотя бы один такой вариант,
+	поэтому поиск - это несколько обращений к словарю, без перебора пар.
+	"""
+
+	def __init__(self, keys=()):
+		self.variants = {}						# вариант -> [ключи]
+		for key in keys:
+			for variant in deletions(key):
+				self.variants.setdefault(variant, []).append(key)
+
+	def find(self, key):
+		"""Ключи индекса на расстоянии одной опечатки от key"""
+		found = set()
+		for variant in deletions(key):
+			for candidate in self.variants.get(variant, ()):
+				if candidate not in found and within_one_typo(key, candidate):
+					found.add(candidate)
+		return found
+
+
+class CarRecord:
+	"""Машина с водителем из базы такси.
+
+	Создаётся только для найденных в чёрном списке машин. Поддерживает доступ
+	как к словарю (record['balans'], record.get('f')), которым раньше были
+	данные get_cardata.
+	"""
+
+	# Порядок полей совпадает с колонками FLEET_SQL / PLATES_SQL
+	__slots__ = ('signal', 'number', 'marka', 'year', 'color', 'open_time', 'balans', 'f', 'i', 'o', 'phone3', 'phone2', 'phone1')
+
+	def __init__(self, signal, number, marka, year, color, open_time, balans, f, i, o, phone3, phone2, phone1):
+		self.signal = signal
+		self.number = number
+		self.marka = marka
+		self.year = year
+		self.color = color
+		self.open_time = open_time
+		self.balans = balans			# "Duty"
+		self.f = f
+		self.i = i
+		self.o = o
+		self.phone3 = phone3			# "Phone1"
+		self.phone2 = phone2			# "Phone2"
+		self.phone1 = phone1			# "MPhone"
+
+	def __getitem__(self, key):
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key) from None
+
+	def get(self, key, default=None):
+		return getattr(self, key, default)
+
+	def to_dict(self):
+		return {name: getattr(self, name) for name in self.__slots__}
+
+	def __repr__(self):
+		return f'<CarRecord {self.number} signal={self.signal}>'
+
+
+SIGNAL = CarRecord.__slots__.index('signal')
+# Телефоны водителя в строке автопарка (Phone1, Phone2, MPhone)
+PHONE_COLUMNS = (
+	CarRecord.__slots__.index('phone3'),
+	CarRecord.__slots__.index('phone2'),
+	CarRecord.__slots__.index('phone1'),
+)
+
+
+def row_phones(row):
+	"""Нормализованные телефоны водителя из строки автопарка без повторов"""
+	phones = []
+	for column in PHONE_COLUMNS:
+		phone = normalize_phone(row[column])
+		if phone and phone not in phones:
+			phones.append(phone)
+	return phones
+
+
+class Fleet:
+	"""Автопарк такси: номер -> строка из Firebird (кортеж).
+
+	Строки читаются через fetchmany и хранятся как есть, без словаря на каждую
+	машину; CarRecord собирается только при обращении fleet[номер], то есть
+	для совпадений с чёрным списком. Номер ищется и по каноническому виду
+	(normalize_plate), так что 'АА 1234 ВВ' найдёт 'AA1234BB'.
+
+	У машины может быть несколько строк (водители-сменщики): в rows остаётся
+	последняя, а телефоны индексируются по всем строкам (phone_index).
+	"""
+
+	def __init__(self):
+		self.rows = {}
+		self.index = PlateIndex()
+		self.near_miss_index = None
+		self.phones = None				# телефон -> [(номер, позывной)], см. phone_index
+		self.replaced = []				# Строки, вытесненные из rows более поздней строкой той же машины
+
+	def load(self, cur, fetch_size=FLEET_FETCH_SIZE):
+		"""Дочитывает результат выполненного запроса курсора"""
+		while True:
+			rows = cur.fetchmany(fetch_size)
+			if not rows:
+				break
+			self.extend(rows)
+		return self
+
+	def extend(self, rows):
+		for row in rows:
+			row = tuple(row)
+			number = row[1]
+			previous = self.rows.get(number)
+			if previous is not None:
+				self.replaced.append(previous)
+			self.rows[number] = row
+			self.index.add(number)
+		self.phones = None
+		return self
+
+	def all_rows(self):
+		"""Все прочитанные строки; extend(all_rows()) восстанавливает тот же автопарк"""
+		return self.replaced + list(self.rows.values())
+
+	def phone_index(self):
+		"""Телефон -> [(номер, позывной)] по всем строкам, включая вытесненные (строится при первом вызове)"""
+		if self.phones is None:
+			phones = {}
+			for row in self.all_rows():
+				car = (row[1], row[SIGNAL])
+				for phone in row_phones(row):
+					cars = phones.setdefault(phone, [])
+					if car not in cars:
+						cars.append(car)
+			self.phones = phones
+		return self.phones
+
+	def find(self, number):
+		"""Номер в автопарке, совпадающий с number с точностью до написания, или None"""
+		if number in self.rows:
+			return number
+		return self.index.get(normalize_plate(number))
+
+	def find_key(self, key):
+		"""То же по уже нормализованному номеру"""
+		return self.index.get(key)
+
+	def find_near_misses(self, key):
+		"""Номера автопарка, отличающиеся от ключа key одной опечаткой (индекс строится при первом вызове)"""
+		if self.near_miss_index is None:
+			self.near_miss_index = NearMissIndex(self.index)
+		return [self.index[candidate] for candidate in self.near_miss_index.find(key)]
+
+	def __contains__(self, number):
+		return self.find(number) is not None
+
+	def __getitem__(self, number):
+		found = self.find(number)
+		if found is None:
+			raise KeyError(number)
+		return CarRecord(*self.rows[found])
+
+	def get(self, number, default=None):
+		found = self.find(number)
+		return CarRecord(*self.rows[found]) if found is not None else default
+
+	def __iter__(self):
+		return iter(self.rows)
+
+	def __len__(self):
+		return len(self.rows)
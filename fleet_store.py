@@ -0,0 +1,45 @@
+import hashlib
+from datetime import datetime
+
+import fleet
+import metrics
+
+def fleet_hash(cars):
+	"""Хэш содержимого автопарка: снимок перезаписывается, только если он изменился"""
+	digest = hashlib.sha256()
+	for row in cars.all_rows():
+		digest.update(repr(row).encode())
+	return digest.hexdigest()
+
+
+def save_snapshot(db, taxi, cars):
+	"""Сохраняет автопарк такси (fleet.Fleet) в SQLite; True, если снимок изменился и был записан"""
+	content_hash = fleet_hash(cars)
+	if content_hash == db.get_meta(f'fleet_hash:{taxi}'):
+		return False
+	with metrics.stage('fleet_snapshot', taxi=taxi):
+		# Decimal и datetime из Firebird преобразует адаптер sqlite3 (см. database.py)
+		rows = [(fleet.normalize_plate(number),) + row for number, row in cars.rows.items()]
+		# Телефоны - по всем строкам автопарка, включая водителей-сменщиков
+		phones = list(dict.fromkeys((phone, fleet.normalize_plate(number)) for phone, numbers in cars.phone_index().items() for number, signal in numbers))
+		db.save_fleet_snapshot(taxi, rows, phones, content_hash)
+	return True
+
+
+def snapshot_time(db, taxi):
+	"""Когда сохранён снимок автопарка такси (datetime) или None"""
+	updated = db.get_meta(f'fleet_updated:{taxi}')
+	return datetime.fromtimestamp(float(updated)) if updated else None
+
+
+def find_by_plate(db, plate):
+	"""[(taxi, CarRecord)] во всех снимках; номер сравнивается в каноническом виде"""
+	return [(taxi, fleet.CarRecord(*row)) for taxi, *row in db.find_fleet_by_plate(fleet.normalize_plate(plate))]
+
+
+def find_by_phone(db, phone):
+	"""[(taxi, CarRecord)] машин водителей с этим телефоном во всех снимках"""
+	phone = fleet.normalize_phone(phone)
+	if not phone:
+		return []
+	return [(taxi, fleet.CarRecord(*row)) for taxi, *row in db.find_fleet_by_phone(phone)]
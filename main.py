@@ -1,19 +1,32 @@
 import requests
 from requests import sessions
 import json
-import re
-from time import sleep
+from time import monotonic
 import police
 import taxi_data
 import utils
 
 from loguru import logger
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import firebirdsql as fdb
 import telebot
 from bs4 import BeautifulSoup
-from datetime import timedelta, datetime, time
+from datetime import timedelta, datetime
 import database
+import blacklist
+import firebird_pool
+import fleet
+import fleet_store
+import bot_commands
+import drivers
+import enrichment
+import metrics
+import recorder
+import outbox
+import scheduler
+import driver_stats
+import async_engine
 import os
 from dotenv import load_dotenv
 import sentry_sdk
@@ -35,30 +48,61 @@ else:
 
 DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
 
+# ===== ЧЁРНЫЙ СПИСОК =====
+BLACKLIST_SERVERS = (303, 296)
+# Все сервера WD (для статистики водителя)
+WD_SERVERS = {'13+1 (Киев)': '298', '14+1 (Киев)': '297', '15+1 (Киев)': '295', 'Комфорт (15+1) (Киев)': '303', 'Стандарт (14плюс1) (Киев)': '296'}
+DRIVER_STATS = os.getenv('DRIVER_STATS', 'False').lower() == 'true'	# Добавлять в уведомление позывной и фирмы из WD
+NEAR_MISS = os.getenv('NEAR_MISS', 'False').lower() == 'true'			# Сообщать о номерах, отличающихся одной опечаткой
+PHONE_MATCH = os.getenv('PHONE_MATCH', 'False').lower() == 'true'		# Искать другие машины водителей из чёрного списка по телефону
+SHARED_DRIVERS = os.getenv('SHARED_DRIVERS', 'False').lower() == 'true'	# Сообщать о водителях, работающих в нескольких наших такси
+
+# ===== РАСПИСАНИЕ =====
+WORK_START = scheduler.parse_time(os.getenv('WORK_START', '09:10'))			# Начало рабочего окна
+WORK_END = scheduler.parse_time(os.getenv('WORK_END', '20:30'))				# Конец рабочего окна
+# Загрузка чёрного списка и проверка только изменений
+BLACKLIST_INTERVAL = timedelta(minutes=float(os.getenv('BLACKLIST_INTERVAL_MINUTES', '60')))
+# Полная проверка всего чёрного списка по автопаркам
+SCAN_INTERVAL = timedelta(minutes=float(os.getenv('SCAN_INTERVAL_MINUTES', '360')))
+# Проверка наличия сессии WD
+SESSION_INTERVAL = timedelta(minutes=float(os.getenv('SESSION_INTERVAL_MINUTES', '60')))
+SESSION_RETRY = timedelta(minutes=1)
+MAX_ERRORS_BEFORE_ALERT = 3
+
+# ===== ПАРАЛЛЕЛЬНАЯ ЗАГРУЗКА АВТОПАРКОВ =====
+TAXIS_LIST = ['Jet', 'Fly', 'Magdack', '898', 'Allo']
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', '5'))			# Размер пула потоков для Firebird
+FETCH_TIMEOUT = float(os.getenv('FETCH_TIMEOUT', '300'))		# Таймаут загрузки одного такси, сек
+FETCH_POLL_INTERVAL = 1.0
+# full - выгружать весь автопарк, pushdown - только машины из чёрного списка
+CARDATA_MODE = os.getenv('CARDATA_MODE', 'full').lower()
+CARDATA_CHUNK_SIZE = int(os.getenv('CARDATA_CHUNK_SIZE', '500'))	# Номеров в одном IN (...)
+FLEET_SNAPSHOT = os.getenv('FLEET_SNAPSHOT', 'True').lower() == 'true'	# Сохранять автопарки в SQLite для команд бота
+ENGINE = os.getenv('ENGINE', 'threads').lower()						# threads | asyncio
+
 # ===== TELEGRAM BOT ИНИЦИАЛИЗАЦИЯ =====
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not TELEGRAM_BOT_TOKEN:
 	raise ValueError('TELEGRAM_BOT_TOKEN not found in environment variables')
 
 bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
+outbox_dispatcher = None
+engine = None
 
 
-def send_message(text, chat_id):
-	try:
-		sleep(5)
-		bot.send_message(chat_id, text)
-	except Exception as EX:
-		logger.exception(EX)
+def save_notifications(records, messages):
+	''' Отметки processed_cars и уведомления outbox - одной транзакцией; отправляет фоновый OutboxDispatcher
 
-class evos():
-	host = '10.0.15.5'
-	database = 'C:/taxi/DB/TAXI.GDB'
-	user = 'SYSDBA'
-	password = 'masterkey'
+	records - (taxi, ключ processed_cars), messages - (chat_id, текст). Ошибка
+	SQLite пробрасывается: такси считается непроверенным, и цикл повторится.
+	'''
+	db.save_notifications(records, messages)
+	if messages and outbox_dispatcher:
+		outbox_dispatcher.notify()
 
 def log(text):
+	# Файл log.log подключается один раз в utils.setup_logging
 	if DEBUG:
-		logger.add('log.log', level='DEBUG')
 		logger.debug(text)
 
 
@@ -73,16 +117,8 @@ def get_tn_data(taxi):
 
 
 	
-@logger.catch
-def get_cardata(host, database, taxi_name='Unknown'):
-	''' Получение данных авто из Firebird базы с обработкой ошибок '''
-	connect = None
-	try:
-		connect = fdb.connect(host=host, database=database, user=evos.user, password=evos.password, charset='UTF8')
-		# connect = fdb.connect(host=evos.host, database=evos.database, user=evos.user, password=evos.password, charset='UTF8')
-		cur = connect.cursor()
-		# sql = 'select "Car_No", "Marka", "Year", "Color", "Signal" from "Cars"'
-		sql = '''WITH FirstQuery AS (
+# Полная выгрузка автопарка (все машины с водителями)
+FLEET_SQL = '''WITH FirstQuery AS (
     SELECT "Car_No", "Marka", "Year", "Color", "Signal"
     FROM "Cars"
 ),
@@ -97,13 +133,64 @@ JOIN FirstQuery fq ON sq."Signal" = fq."Signal"
 JOIN "Drivers" d ON sq."Driver_No" = d."Driver_No";
 
 '''
-		cur.execute(sql)            				# Выполняем запрос
-		result = cur.fetchall() 				# Получаем результат
-		cur.close()                 				# Закрываем курсор
-		connect.close()								# Закрываем подключение
-		cars = {}
-		for signal, number, marka, year, color, open_time, balans, f,i,o, phone3, phone2, phone1 in result:
-			cars[number] = {'marka':marka, 'year':year, 'color':color, 'signal':signal, 'f':f, 'i':i, 'o':o, 'balans':balans, 'open_time':open_time, 'phone1':phone1, 'phone2':phone2, 'phone3':phone3}
+
+# Выгрузка только машин из чёрного списка (номера передаются параметрами)
+PLATES_SQL = '''SELECT dc."Signal", c."Car_No", c."Marka", c."Year", c."Color", dc."Open_Time", dc."Duty", d."F", d."I", d."O", d."Phone1", d."Phone2", d."MPhone"
+FROM "Cars" c
+JOIN "DriverCar" dc ON dc."Signal" = c."Signal"
+JOIN "Drivers" d ON dc."Driver_No" = d."Driver_No"
+WHERE c."Car_No" IN ({placeholders})
+'''
+
+
+def fetch_cardata_by_plates(cur, plates):
+	""" Выполняет PLATES_SQL пачками по CARDATA_CHUNK_SIZE номеров.
+
+	Firebird ограничивает длину списка IN (не более 1500 элементов), поэтому
+	номера отправляются частями, а результаты собираются в один fleet.Fleet.
+	"""
+	# Номер в базе такси может быть набран кириллицей или латиницей - спрашиваем оба варианта.
+	# Номера с пробелами так не найти: для таких баз нужен CARDATA_MODE=full
+	plates = sorted({variant for plate in plates for variant in fleet.plate_variants(plate)})
+	cars = fleet.Fleet()
+	for offset in range(0, len(plates), CARDATA_CHUNK_SIZE):
+		chunk = plates[offset:offset + CARDATA_CHUNK_SIZE]
+		cur.execute(PLATES_SQL.format(placeholders=', '.join('?' * len(chunk))), chunk)
+		cars.load(cur)
+	return cars
+
+	
+@logger.catch
+@recorder.capture(
+	'cardata',
+	lambda host, database, taxi_name='Unknown', plates=None: taxi_name,
+	encode=lambda cars: cars.all_rows() if cars is not None else None,
+	decode=lambda rows: fleet.Fleet().extend(rows) if rows is not None else None,
+)
+def get_cardata(host, database, taxi_name='Unknown', plates=None):
+	''' Получение данных авто из Firebird базы с обработкой ошибок
+
+	В режиме CARDATA_MODE=pushdown и при переданных plates запрашиваются только
+	машины с этими номерами; при ошибке такого запроса выполняется полная выгрузка.
+	Возвращает fleet.Fleet (номер -> CarRecord) или None, если данные получить не удалось.
+	'''
+	try:
+		# Постоянное подключение из пула: проверяется перед использованием и сбрасывается при ошибке
+		with firebird_pool.pool.acquire(host, database, taxi_name) as connect:
+			cur = connect.cursor()
+			if plates is not None and CARDATA_MODE == 'pushdown':
+				try:
+					cars = fetch_cardata_by_plates(cur, plates)
+				except fdb.Error as pushdown_error:
+					logger.warning(f'Pushdown query failed for {taxi_name}, falling back to full fleet: {pushdown_error}')
+					connect.rollback()
+					cur = connect.cursor()
+					cur.execute(FLEET_SQL)
+					cars = fleet.Fleet().load(cur)
+			else:
+				cur.execute(FLEET_SQL)            		# Выполняем запрос
+				cars = fleet.Fleet().load(cur)			# Читаем результат порциями
+			cur.close()                 				# Закрываем курсор
 		logger.info(f'Successfully fetched {len(cars)} cars from {taxi_name}')
 		return cars
 	except fdb.Error as firebird_error:
@@ -111,18 +198,14 @@ JOIN "Drivers" d ON sq."Driver_No" = d."Driver_No";
 		full_error = f'Firebird error for {taxi_name} ({host}): {error_msg}'
 		logger.error(full_error)
 		sentry_sdk.capture_exception(firebird_error)
+		# Группа повторов - по хосту, чтобы сводка показывала все недоступные базы
 		utils.send_error_notification(
 			'Firebird Connection Error',
 			full_error,
-			'ERROR'
+			'ERROR',
+			source=f'get_cardata {taxi_name} ({host})'
 		)
-		if connect:
-			try:
-				connect.rollback()
-				connect.close()
-			except Exception as cleanup_error:
-				logger.exception(cleanup_error)
-		return {}
+		return None
 	except Exception as EX:
 		error_msg = f'Unexpected error fetching car data from {taxi_name}: {str(EX)}'
 		logger.exception(error_msg)
@@ -130,22 +213,17 @@ JOIN "Drivers" d ON sq."Driver_No" = d."Driver_No";
 		utils.send_error_notification(
 			'Car Data Fetch Error',
 			error_msg,
-			'ERROR'
+			'ERROR',
+			source=f'get_cardata {taxi_name} ({host})'
 		)
-		if connect:
-			try:
-				connect.rollback()
-				connect.close()
-			except Exception as cleanup_error:
-				logger.exception(cleanup_error)
-		return {}
+		return None
 
 
 ##################################################################################################
 @logger.catch
 def get_session(login, password):
-	''' Авторизация на WD с проверкой доступности и обработкой ошибок '''
-	return utils.get_session_with_auth(login, password)
+	''' Сессия WD: из сохранённых кук или новая авторизация с проверкой доступности '''
+	return utils.get_wd_session(login, password)
 
 
 @logger.catch
@@ -166,24 +244,30 @@ def parse_data(result):
 
 
 @logger.catch
-def check_number_on_block_by_soz(session, server_id, black_list):
-	""" Проверяем номер авто на предмет блокировки по одному серверу с обработкой 503 """
+def fetch_black_list_page(session, server_id, page=1):
+	""" Загружает одну страницу чёрного списка сервера с обработкой 503.
+
+	Ответ целиком сохраняется в blacklist.RawPage без разбора строк: они
+	разбираются, только если хэш всех страниц изменился. Возвращает
+	blacklist.RawPage или None при ошибке.
+	"""
 	try:
-		check_data = {"Group.Id":server_id,"_search":"true","rows":"5000","page":"1","sidx":"Id","sord":"asc","User.FullName":"СОЗ"}
-		url = 'http://wd.soz.in.ua/CarInfoBlackByGroup/SearchData/'
+		check_data = blacklist.black_list_query(server_id, page)
+		url = blacklist.BLACKLIST_URL
 
 		# Первая попытка обычным способом
-		response = utils.make_request('GET', url, session, data=check_data)
+		response = utils.make_request('GET', url, session, data=check_data, stream=True)
 
 		# Если 503 - пробуем с прокси
-		if response and response.status_code == 503:
+		if response is not None and response.status_code == 503:
+			response.close()
 			logger.warning('Got 503 from WD, trying with proxy...')
 			utils.send_error_notification(
 				'WD Server 503',
 				f'WD returned 503 for server {server_id}, attempting with proxy',
 				'WARNING'
 			)
-			response = utils.make_request('GET', url, session, data=check_data, use_proxy=True)
+			response = utils.make_request('GET', url, session, data=check_data, use_proxy=True, stream=True)
 
 		if response is None:
 			logger.error(f'Failed to get blacklist for server {server_id}')
@@ -192,27 +276,21 @@ def check_number_on_block_by_soz(session, server_id, black_list):
 				f'Could not fetch blacklist for server {server_id}',
 				'ERROR'
 			)
-			return {}
-
-		if response.status_code >= 400:
-			logger.error(f'Got HTTP {response.status_code} from WD')
-			utils.send_error_notification(
-				'WD HTTP Error',
-				f'WD returned HTTP {response.status_code} for server {server_id}',
-				'ERROR'
-			)
-			return {}
+			return None
 
-		result = response.json()
-		if result['total'] > 0:
-			for row in result['rows']:
-				carnum = row['cell'][0]
-				description = row['cell'][1]
-				black_list[carnum] = description
-		return black_list
+		with response:
+			if response.status_code >= 400:
+				logger.error(f'Got HTTP {response.status_code} from WD')
+				utils.send_error_notification(
+					'WD HTTP Error',
+					f'WD returned HTTP {response.status_code} for server {server_id}',
+					'ERROR'
+				)
+				return None
+			return blacklist.read_page(response.iter_content(blacklist.BLACKLIST_CHUNK_SIZE))
 
 	except Exception as err:
-		error_msg = f'Error checking blacklist for server {server_id}: {str(err)}'
+		error_msg = f'Error checking blacklist for server {server_id} (page {page}): {str(err)}'
 		logger.exception(error_msg)
 		sentry_sdk.capture_exception(err)
 		utils.send_error_notification(
@@ -220,174 +298,310 @@ def check_number_on_block_by_soz(session, server_id, black_list):
 			error_msg,
 			'ERROR'
 		)
+		return None
+
+
+def download_black_list(session, servers=BLACKLIST_SERVERS):
+	""" Загружает все страницы чёрного списка со всех серверов.
+
+	Сначала параллельно загружаются первые страницы серверов (из них берётся
+	число страниц, см. blacklist.page_count), затем - все остальные. Страницы
+	сервера после пустой или после получения всех records строк не нужны: их
+	запросы отменяются. Возвращает
+	blacklist.BlacklistPages или None, если хоть одна страница не загрузилась.
+	"""
+	servers = list(servers)
+	pages = {}
+	with metrics.stage('blacklist_download'), ThreadPoolExecutor(max_workers=blacklist.BLACKLIST_WORKERS, thread_name_prefix='blacklist') as executor:
+		first_pages = dict(zip(servers, executor.map(lambda server: fetch_black_list_page(session, server, 1), servers)))
+		if any(page is None for page in first_pages.values()):
+			return None
+		futures = {}
+		for server, first in first_pages.items():
+			pages[(server, 1)] = first
+			count = blacklist.page_count(first)
+			log(f"Download BlackList for server:{server}: {first.records} records, {count} pages (total {first.total})")
+			futures[server] = [(page, executor.submit(fetch_black_list_page, session, server, page)) for page in range(2, count + 1)]
+		try:
+			for server, server_futures in futures.items():
+				rows = first_pages[server].rows
+				for index, (page, future) in enumerate(server_futures):
+					result = future.result()
+					if result is None:
+						return None
+					pages[(server, page)] = result
+					rows += result.rows
+					if blacklist.is_last_page(first_pages[server], result, rows):
+						for page, rest in server_futures[index + 1:]:
+							rest.cancel()
+						break
+		finally:
+			for server_futures in futures.values():
+				for page, future in server_futures:
+					future.cancel()
+	pages = blacklist.BlacklistPages(servers, pages)
+	for server in servers:
+		rows = pages.rows(server)
+		if first_pages[server].records is not None and rows != first_pages[server].records:
+			logger.warning(f'Blacklist for server {server} changed during download: {rows} rows, {first_pages[server].records} expected')
+	return pages
+
+
+def get_hits_statistics(session, hits, taxi_name):
+	""" Позывной и фирмы из WD для найденных машин (если включено DRIVER_STATS) """
+	if not DRIVER_STATS or session is None or not hits:
+		return {}
+	try:
+		with metrics.stage('driver_stats'):
+			return driver_stats.get_batch_statistics(session, WD_SERVERS, hits, taxi_name)
+	except Exception as EX:
+		logger.exception(f'Driver statistics failed for {taxi_name}: {EX}')
 		return {}
 
-@logger.catch
-def get_id_in_server(server_id, taxi_name, session):
-	"""Получение айди службы в списке служб сервера"""
-	result = session.get(f'http://wd.soz.in.ua/TaxiGroup/SelectByGroup?group={server_id}').json()
-	for id in result: 
-		if taxi_name in result[id]: return id
 
-@logger.catch
-def get_driver_statistics(session, servers, car_num, taxi_name):
-	''' Получение статистики соз по номеру авто '''
+def fetch_taxi(taxi, started, plates=None):
+	""" Загрузка автопарка одного такси (выполняется в пуле потоков) """
+	started[taxi] = monotonic()
+	with logger.contextualize(taxi=taxi):
+		with metrics.stage('fleet_fetch', taxi=taxi):
+			host, database, taxi_name, chat_id = get_tn_data(taxi)
+			logger.info(f'Fetching cars from {taxi_name}...')
+			cars = get_cardata(host, database, taxi_name, plates)
+		if cars is not None:
+			metrics.FLEET_ROWS.set(len(cars), taxi=taxi)
+			metrics.FLEET_ROWS_FETCHED.inc(len(cars), taxi=taxi)
+			save_fleet_snapshot(taxi, cars)
+	return taxi_name, chat_id, cars
+
+
+def save_fleet_snapshot(taxi, cars):
+	""" Снимок автопарка для команд бота; в режиме pushdown автопарк неполный и не сохраняется """
+	if not FLEET_SNAPSHOT or CARDATA_MODE == 'pushdown':
+		return
 	try:
+		if fleet_store.save_snapshot(db, taxi, cars):
+			logger.info(f'Fleet snapshot saved: {len(cars)} cars')
+	except Exception as EX:
+		logger.exception(f'Failed to save fleet snapshot for {taxi}: {EX}')
 
-		if str(type(servers)) == "<class 'dict'>":
-			server_list = servers
-		elif str(type(servers)) == "<class 'list'>":
-			server_list = {}
-			for server, server_id in servers:
-				server_list.update({server:server_id})
-		else:
-			return None
 
-		finish = datetime.now().strftime('%d.%m.%Y')            # Завтра (конечная дата месяц а)
-		start = (datetime.now() - timedelta(days=30)).strftime('%d.%m.%Y')            # Завтра (конечная дата месяц а)
-		period = f"{start}+-+{finish}"
-		work_in_taxi = []
-		pozivnoi = None
-
-		for server in server_list:
-			taxi_id_in_server = get_id_in_server(server_list[server], taxi_name, session)
-			data = {'group':server_list[server], '_search':'true', 'rows':10000, 'page':1, 'sidx':'ReqStartTime', 'ReqStartTime':period, 'TaxiIdFrom':taxi_id_in_server, 'CarNo':car_num}
-			# ic(data)
-			result = session.get('http://wd.soz.in.ua/Order/SearchData', data=data).json()
-			if int(result['total']) > 0:
-				for row in result['rows']:
-					taxi_from_car = row['cell'][11]
-					work_in_taxi.append(taxi_from_car)
-					if taxi_name in taxi_from_car:
-						our_car = True
-						pozivnoi = row['cell'][14]
-						car = row['cell'][16]
-						color = row['cell'][17]
-		if pozivnoi:
-			new_data = []
-			work_in_taxi = list(set(work_in_taxi))
-			for val in work_in_taxi:
-				for server in servers:
-					val = val.replace(' ' + server, '')
-				new_data.append(val)
-			firms = ''
-			for firm in list(set(new_data)): firms += firm + ', '
-			
-			return pozivnoi, firms[:-2]
-		else:
-			return None
-	except Exception as err:
-		logger.info('_________________________________________________________________________________________')
-		logger.opt(exception=True).error(err)
-		return None
-	
+def fetch_fleets(taxis, plates=None):
+	""" Параллельная загрузка автопарков всех такси.
+
+	Результаты отдаются по мере готовности, поэтому медленный или недоступный
+	хост задерживает только уведомления своего такси. Таймаут считается для
+	каждого такси отдельно, с момента начала его загрузки.
+	"""
+	started = {}												# Время начала загрузки по такси
+	executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='fetch')
+	futures = {executor.submit(fetch_taxi, taxi, started, plates): taxi for taxi in taxis}
+	pending = set(futures)
+	try:
+		while pending:
+			done, pending = wait(pending, timeout=FETCH_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+			for future in done:
+				taxi = futures[future]
+				try:
+					yield taxi, future.result()
+				except Exception as EX:
+					logger.exception(f'❌ Error fetching {taxi}: {EX}')
+			now = monotonic()
+			for future in list(pending):
+				taxi = futures[future]
+				if taxi in started and now - started[taxi] > FETCH_TIMEOUT:
+					pending.discard(future)
+					error_msg = f'Fetching car data from {taxi} took longer than {FETCH_TIMEOUT:.0f}s, skipping this cycle'
+					logger.error(error_msg)
+					utils.send_error_notification('Car Data Fetch Timeout', error_msg, 'ERROR', source=f'fetch_fleets {taxi}')
+	finally:
+		# Зависшие потоки не ждём: они завершатся сами, а цикл идёт дальше
+		executor.shutdown(wait=False, cancel_futures=True)
+
+
+def find_hits(taxi, cars, black_list, plate_index=None):
+	""" Номера из чёрного списка, найденные в автопарке и ещё не отправленные.
+
+	Номера сравниваются в каноническом виде (fleet.normalize_plate), поэтому
+	кириллица/латиница и пробелы не мешают совпадению. plate_index - индекс
+	чёрного списка, построенный один раз на цикл для всех такси.
+	"""
+	if plate_index is None:
+		plate_index = fleet.PlateIndex(black_list)
+	found = [carnum for key, carnum in plate_index.items() if cars.find_key(key) is not None]
+	hits = [carnum for carnum in found if not db.check_record(carnum, taxi)]
+	metrics.HITS.inc(len(hits), taxi=taxi)
+	metrics.DEDUP_SKIPS.inc(len(found) - len(hits), taxi=taxi)
+	return hits
+
+
+def find_near_misses(taxi, cars, black_list, plate_index=None):
+	""" Пары (номер из чёрного списка, номер в автопарке), отличающиеся одной опечаткой.
+
+	Ищутся только для номеров без точного совпадения, по индексу удалений
+	автопарка (fleet.NearMissIndex). Включается NEAR_MISS и имеет смысл при
+	CARDATA_MODE=full: в режиме pushdown автопарк содержит только точные совпадения.
+	"""
+	if not NEAR_MISS:
+		return []
+	if plate_index is None:
+		plate_index = fleet.PlateIndex(black_list)
+	near_misses = []
+	for key, carnum in plate_index.items():
+		if cars.find_key(key) is not None:
+			continue
+		for fleet_plate in cars.find_near_misses(key):
+			# Машина сама есть в чёрном списке - о ней придёт обычное уведомление
+			if fleet.normalize_plate(fleet_plate) in plate_index:
+				continue
+			if not db.check_record(database.near_miss_key(carnum, fleet_plate), taxi):
+				near_misses.append((carnum, fleet_plate))
+	metrics.NEAR_MISSES.inc(len(near_misses), taxi=taxi)
+	return near_misses
+
+
+def process_taxi(taxi, taxi_name, chat_id, cars, black_list, session=None, plate_index=None):
+	""" Сравнение автопарка такси с чёрным списком и отправка уведомлений.
+
+	Данные baza-gai и статистика WD запрашиваются для всех находок такси сразу,
+	затем тексты собираются одной пачкой (enrichment) и ставятся в очередь.
+	"""
+	logger.info(f'Loaded {len(cars)} cars, comparing...')
+	hits = find_hits(taxi, cars, black_list, plate_index)
+	near_misses = find_near_misses(taxi, cars, black_list, plate_index)
+	statistics = get_hits_statistics(session, hits, taxi_name)
+	police_infos = police.check_many(hits + [fleet_plate for carnum, fleet_plate in near_misses])
+	with metrics.stage('render', taxi=taxi):
+		found = enrichment.render_hits(hits, cars, black_list, police_infos, statistics)
+		possible = enrichment.render_near_misses(near_misses, cars, black_list, police_infos)
+	records = []
+	for carnum, message in found:
+		logger.info(f'✅ FOUND: {carnum}')
+		records.append((taxi, carnum))
+	for (carnum, fleet_plate), message in possible:
+		logger.info(f'❔ POSSIBLE MATCH: {carnum} ~ {fleet_plate}')
+		records.append((taxi, database.near_miss_key(carnum, fleet_plate)))
+	# Записи такси и его уведомления - одной транзакцией
+	save_notifications(records, [(chat_id, message) for key, message in found + possible])
+	logger.info(f'✅ {taxi_name}: {len(found)} new blocked cars found')
+
 
 @logger.catch
-def check(black_list, session):
+def check(black_list, session, driver_index=None):
+	''' Сравнение чёрного списка с автопарками всех такси.
+
+	Автопарки добавляются в driver_index (если он передан) для поиска по телефонам.
+	Возвращает True, если все такси проверены без ошибок.
+	'''
 	if not black_list:
 		logger.warning('⚠️  Blacklist is empty, skipping check')
 		return
 
 	logger.info('=' * 80)
 	logger.info('🔎 STARTING CAR CHECK CYCLE')
-	logger.info(f'Checking {len(black_list)} blocked cars across 5 taxis')
+	logger.info(f'Checking {len(black_list)} blocked cars across {len(TAXIS_LIST)} taxis')
 	logger.info('=' * 80)
 
-	taxis_list = ['Jet', 'Fly', 'Magdack', '898', 'Allo']
-	for taxi_idx, taxi in enumerate(taxis_list, 1):
-		logger.add(f"{taxi}.log")
-		try:
-			logger.warning(f'\n🚕 [{taxi_idx}/5] TAXI: {taxi}')
-			log(f'Search blocked driver in taxi: {taxi}')
-			host, database, taxi_name, chat_id = get_tn_data(taxi)
-			logger.info(f'Fetching {len(black_list)} cars from {taxi_name}...')
-			cars = get_cardata(host, database, taxi_name)
-			if not cars:
-				logger.warning(f'Failed to get car data for {taxi}')
-				logger.remove()
-				continue
-			logger.info(f'Loaded {len(cars)} cars, comparing...')
-			count = 0
-			for carnum in black_list:
-				if carnum in cars:
-					try:
-						if db.check_record(carnum, taxi): continue
-						count += 1
-						data = cars[carnum]
-						contacts = ''
-						if data.get('f'): contacts += f"{data['f']} "
-						if data.get('i'): contacts += f"{data['i']} "
-						if data.get('o'): contacts += f"{data['o']} "
-						phones = []
-						for phone in (data.get('phone1'), data.get('phone2'), data.get('phone3')):
-							phone = standart_phone(phone)
-							if not phone:continue
-							if phone in phones: continue
-							phones.append(phone)
-						for phone in phones: contacts += f'\n{phone}'
-						contacts += f"\nБаланс: {round(data['balans'],2)}"
-						if data.get('open_time'):
-							open_time = data.get('open_time')
-							try:
-								open_time_datetime = datetime.strptime(str(open_time), '%Y-%m-%d %H:%M:%S.%f')
-								formatted_open_time = open_time_datetime.strftime('%Y-%m-%d')
-								contacts += f"\nБыл в программе: {formatted_open_time}"
-
-							except ValueError:
-								if open_time:
-									formatted_open_time = str(open_time)
-									contacts += f"\nБыл в программе: {formatted_open_time}"
-
-						message = f'''{carnum} - позывной: {data['signal']}, марка:  {data['marka']}, год: {data['year']}, цвет: {data['color']}\n\n{contacts}'''
-						police_info = police.check_in_police(carnum)
-						if police_info: message += '\n\nПо данным сайта baza-gai.com.ua: ' + police_info
-						else: message += '\n\nПо данным сайта baza-gai.com.ua: отсутствуют данные по номеру ' + carnum
-						message += f"\n\nПричина блокировки - {black_list[carnum]}"
-						logger.info(f'✅ FOUND: {carnum}')
-						db.insert_record(taxi, carnum)
-						send_message(message, chat_id)
-					except Exception as EX:
-						logger.exception(EX)
-			logger.info(f'✅ {taxi_name}: {count} new blocked cars found')
-		except Exception as taxi_error:
-			logger.exception(f'❌ Error processing {taxi}: {taxi_error}')
-		finally:
-			logger.remove()
+	processed = 0
+	plate_index = fleet.PlateIndex(black_list)
+	for taxi_idx, (taxi, (taxi_name, chat_id, cars)) in enumerate(fetch_fleets(TAXIS_LIST, list(black_list)), 1):
+		with logger.contextualize(taxi=taxi):
+			try:
+				logger.warning(f'\n🚕 [{taxi_idx}/{len(TAXIS_LIST)}] TAXI: {taxi}')
+				log(f'Search blocked driver in taxi: {taxi}')
+				if cars is None:
+					logger.warning(f'Failed to get car data for {taxi}')
+					continue
+				with metrics.stage('taxi_process', taxi=taxi):
+					process_taxi(taxi, taxi_name, chat_id, cars, black_list, session, plate_index)
+					if driver_index is not None:
+						driver_index.add_fleet(taxi, taxi_name, chat_id, cars, black_list, plate_index)
+				processed += 1
+			except Exception as taxi_error:
+				logger.exception(f'❌ Error processing {taxi}: {taxi_error}')
+	police_stats = police.get_cache_stats()
+	logger.info(f"baza-gai.com.ua cache: {police_stats['hits']} hits, {police_stats['misses']} misses")
+	# True, если все такси проверены без ошибок
+	return processed == len(TAXIS_LIST)
 	
 
-@logger.catch
-def standart_phone(phone):
-    """Нормализатор номеров"""
-    
-    phone = re.sub(r"\D", "", phone)                        # Удаляем из номера всё, кроме цифр
-    if re.match(r'^[3][8][0][0-9]{9}$', phone): return phone[2:]                                    # Возвращаем номер без 380
-    elif re.match(r'^[8][0][0-9]{9}$', phone):  return phone[1:]                                    # Возвращаем номер без 80
-    elif re.match(r'^[0][0-9]{9}$', phone):     return phone                                        # Возвращаем номер без 0
-    elif re.match(r'^[0-9]{9}$', phone):        return f"0{phone}"                                  # Возвращаем номер
-    else: return phone                                                                              # Возвращаем ошибку
+def new_driver_index():
+	""" Индекс телефонов на цикл или None, если поиск по телефонам выключен.
+
+	В режиме pushdown автопарки неполные, поэтому индекс не строится.
+	"""
+	if not (PHONE_MATCH or SHARED_DRIVERS) or CARDATA_MODE == 'pushdown':
+		return None
+	return drivers.DriverIndex()
+
+
+def report_drivers(driver_index, black_list):
+	""" Уведомления о машинах водителей из чёрного списка (по телефону) и о водителях в нескольких такси.
+
+	black_list - весь чёрный список: телефоны машин, которых в нём больше нет, не учитываются.
+	"""
+	if driver_index is None:
+		return
+	with metrics.stage('driver_correlation'):
+		# Телефоны из прошлых циклов + найденные сейчас
+		db.save_blacklist_phones(driver_index.blocked)
+		blocked = {phone: entry for phone, entry in db.load_blacklist_phones().items() if entry[0] in black_list}
+		records = {}
+		messages = []
+		if PHONE_MATCH:
+			for phone, carnum, reason, taxi, number, signal in driver_index.phone_matches(blocked):
+				record = (taxi, database.phone_match_key(phone, number))
+				if record in records or db.check_record(record[1], taxi):
+					continue
+				with logger.contextualize(taxi=taxi):
+					logger.info(f'📞 PHONE MATCH: {carnum} ~ {number} ({phone})')
+				records[record] = None
+				messages.append((driver_index.taxis[taxi][1], drivers.render_phone_match(phone, carnum, reason, number, signal)))
+				metrics.PHONE_MATCHES.inc(taxi=taxi)
+		if SHARED_DRIVERS:
+			lines = {}
+			for phone, cars in driver_index.shared_drivers():
+				line = drivers.render_shared_driver(phone, cars, driver_index.taxis)
+				for taxi in {taxi for taxi, number, signal in cars}:
+					if not db.check_record(database.shared_driver_key(phone), taxi):
+						records[(taxi, database.shared_driver_key(phone))] = None
+						lines.setdefault(taxi, []).append(line)
+						metrics.SHARED_DRIVERS.inc(taxi=taxi)
+			for taxi, taxi_lines in lines.items():
+				logger.info(f'👥 {taxi}: {len(taxi_lines)} new drivers shared with other taxis')
+				messages.extend((driver_index.taxis[taxi][1], text) for text in drivers.render_shared_drivers(taxi_lines))
+		save_notifications(records, messages)
 
 
 @logger.catch
-def get_black_list(session=None):
+def get_black_list_update(session, full_scan=False):
+	""" Загружает чёрный список и сравнивает его с последним проверенным снимком.
+
+	Возвращает None, если загрузить список не удалось или его содержимое не
+	изменилось (по хэшу сырых ответов) и полная перепроверка (full_scan) не
+	запрошена: в этом случае страницы не разбираются и сравнение со снимком
+	не выполняется.
+	"""
+	pages = download_black_list(session)
+	if pages is None:
+		return None
+	return build_black_list_update(pages, full_scan)
+
+
+def build_black_list_update(pages, full_scan=False):
+	""" Разбор загруженных страниц и сравнение чёрного списка со снимком """
 	try:
-		login, password = taxi_data.get_wd_credentials()
-		servers = (303, 296)
-		black_list = {}
-		if not session:
-			session = get_session(login, password)
-			if session is None:
-				logger.error('Failed to create session in get_black_list')
-				utils.send_error_notification(
-					'Blacklist Session Error',
-					'Failed to create WD session for blacklist fetching',
-					'ERROR'
-				)
-				return {}
+		content_hash = pages.content_hash
+		if content_hash == db.get_meta('blacklist_hash') and not full_scan:
+			logger.info('Blacklist unchanged since last check, skipping cycle')
+			return None
 
-		for server in servers:
-			log(f"Download BlackList for server:{server}")
-			black_list = check_number_on_block_by_soz(session, server, black_list)
-		return black_list
+		with metrics.stage('blacklist_parse'):
+			black_list = pages.entries()
+		metrics.BLACKLIST_ENTRIES.set(len(black_list))
+		with metrics.stage('blacklist_diff'):
+			diff = blacklist.diff_blacklists(db.load_blacklist_snapshot(), black_list)
+		logger.info(f'Blacklist: {len(black_list)} entries, changes since last check: {diff}' + (' (full rescan)' if full_scan else ''))
+		return blacklist.BlacklistUpdate(black_list, diff, content_hash, full_scan)
 	except Exception as e:
 		error_msg = f'Error getting blacklist: {str(e)}'
 		logger.exception(error_msg)
@@ -397,85 +611,189 @@ def get_black_list(session=None):
 			error_msg,
 			'ERROR'
 		)
-		return {}
+		return None
+
+
+def commit_black_list(update):
+	""" Сохраняет проверенный снимок чёрного списка """
+	with metrics.stage('snapshot_commit'):
+		db.save_blacklist_snapshot(update.black_list, update.content_hash)
+	if update.full_scan:
+		db.set_meta('last_full_scan', datetime.now().timestamp())
 
 
 def check2(black_list):
 	pass
 
 
-@logger.catch
-def check_work_time():
-	start = time(9,10)
-	finish = time(20,30)
-	now = datetime.now().time()
+def session_job():
+	""" Создаёт сессию WD, если её ещё нет; при ошибке повторяет через минуту """
+	global session, session_errors
+	if session is not None:
+		return
+	session = get_session(login, password)
+	if session is None:
+		session_errors += 1
+		if session_errors >= MAX_ERRORS_BEFORE_ALERT:
+			utils.send_error_notification(
+				'WD Session Failed',
+				f'Failed to create WD session {session_errors} times in a row',
+				'CRITICAL'
+			)
+			session_errors = 0
+		logger.error('Failed to create WD session, retrying...')
+		jobs.postpone('session', SESSION_RETRY)
+	else:
+		logger.info('WD session initialized successfully')
+		session_errors = 0
 
-	if now > start and now < finish:
+
+def run_cycle(full_scan=False):
+	""" Загрузка чёрного списка и проверка изменений (или всего списка) по автопаркам.
+
+	Возвращает False, если цикл не запускался из-за отсутствия сессии WD.
+	"""
+	if session is None:
+		logger.warning('No WD session, skipping cycle')
 		return False
-	else:
-		log(f'No work_time: {now}')
-		return True
+	with metrics.cycle(full_scan):
+		if engine is not None:
+			engine.run_cycle(session, full_scan)
+			return True
+		update = get_black_list_update(session, full_scan)
+		if update is None:
+			return True
+		# Снимок сохраняется только после успешной проверки всех такси,
+		# иначе изменения будут проверены ещё раз в следующем цикле
+		to_check = update.to_check()
+		driver_index = new_driver_index() if to_check else None
+		if not to_check or check(to_check, session, driver_index):
+			commit_black_list(update)
+		report_drivers(driver_index, update.black_list)
+	return True
+
+
+def blacklist_job():
+	if not run_cycle():
+		jobs.postpone('blacklist', SESSION_RETRY)
+
+
+def scan_job():
+	if not run_cycle(full_scan=True):
+		jobs.postpone('scan', SESSION_RETRY)
+		return
+	# Полная проверка включает в себя и проверку изменений
+	jobs.postpone('blacklist')
+
+
+def on_job_error(job, error):
+	global error_count
+	error_count += 1
+	error_msg = f'Error in job {job.name} (count: {error_count}): {str(error)}'
+	sentry_sdk.capture_exception(error)
+	if error_count >= MAX_ERRORS_BEFORE_ALERT:
+		utils.send_error_notification(
+			'Main Loop Critical Error',
+			error_msg,
+			'CRITICAL'
+		)
+		error_count = 0
+
+
+def on_job_success(job):
+	# Алерт - только после MAX_ERRORS_BEFORE_ALERT ошибок подряд
+	global error_count
+	error_count = 0
+
+
+def start_delivery():
+	""" Запускает рассылку уведомлений (и asyncio-движок при ENGINE=asyncio).
+
+	Возвращает (engine, outbox_dispatcher); engine равен None в режиме threads.
+	"""
+	if ENGINE == 'asyncio':
+		engine = async_engine.AsyncEngine(db, TELEGRAM_BOT_TOKEN, async_engine.Pipeline(
+			taxis=TAXIS_LIST,
+			servers=BLACKLIST_SERVERS,
+			build_update=build_black_list_update,
+			commit_update=commit_black_list,
+			get_fleet=lambda taxi, plates: fetch_taxi(taxi, {}, plates),
+			find_hits=find_hits,
+			find_near_misses=find_near_misses,
+			get_stats=get_hits_statistics,
+			driver_index=new_driver_index,
+			report_drivers=report_drivers,
+			fetch_timeout=FETCH_TIMEOUT,
+			fetch_workers=FETCH_WORKERS,
+		), on_error=utils.send_error_notification)
+		engine.start()
+		return engine, engine.outbox
+	dispatcher = outbox.OutboxDispatcher(db, bot, on_error=utils.send_error_notification)
+	dispatcher.start()
+	return None, dispatcher
+
+
+def start_commands():
+	""" Команды бота /plate и /phone для чатов такси (если включено BOT_COMMANDS) """
+	if not bot_commands.BOT_COMMANDS:
+		return None
+	taxis = {}
+	chats = set(bot_commands.BOT_ALLOWED_CHATS)
+	for taxi in TAXIS_LIST:
+		data = get_tn_data(taxi)
+		if data:
+			taxis[taxi] = data[2]
+			chats.add(data[3])
+	commands = bot_commands.BotCommands(bot, db, taxis, chats)
+	commands.start()
+	return commands
+
+
+def stop_delivery():
+	if engine is not None:
+		engine.stop()
+	elif outbox_dispatcher is not None:
+		outbox_dispatcher.stop()
+
 	
 if __name__ == '__main__':
 	try:
+		utils.setup_logging(TAXIS_LIST, DEBUG)
 		logger.info('WD Block Notificator started')
 		db = database.Database()
+		police.init_cache(db)
+		engine, outbox_dispatcher = start_delivery()
+		commands = start_commands()
+		metrics.start_server()
 
 		# Получаем учётные данные из .env
 		login, password = taxi_data.get_wd_credentials()
 		if not login or not password:
 			raise ValueError('WD_LOGIN and WD_PASSWORD must be set in .env')
 
-		servers = {'13+1 (Киев)': '298', '14+1 (Киев)': '297', '15+1 (Киев)': '295', 'Комфорт (15+1) (Киев)': '303', 'Стандарт (14плюс1) (Киев)': '296'}
+		servers = WD_SERVERS
 		session = None
-		session_update_count = 0
+		session_errors = 0
 		error_count = 0
-		MAX_ERRORS_BEFORE_ALERT = 3
 
-		while True:
-			try:
-				# Переинициализируем сессию каждые 6 часов (6 итераций по 60 минут)
-				if session is None or session_update_count >= 6:
-					session = get_session(login, password)
-					if session is None:
-						error_count += 1
-						if error_count >= MAX_ERRORS_BEFORE_ALERT:
-							utils.send_error_notification(
-								'WD Session Failed',
-								f'Failed to create WD session {error_count} times in a row',
-								'CRITICAL'
-							)
-							error_count = 0
-						logger.error('Failed to create WD session, retrying...')
-						sleep(60)  # Ждём 1 минуту перед повтором вместо 60 минут
-						continue
-					else:
-						session_update_count = 0
-						logger.info('WD session reinitialized successfully')
-						error_count = 0
-
-				black_list = get_black_list(session)
-				if not check_work_time():
-					check(black_list, session)
-				session_update_count += 1
-			except Exception as e:
-				error_count += 1
-				error_msg = f'Error in main loop (count: {error_count}): {str(e)}'
-				logger.exception(error_msg)
-				sentry_sdk.capture_exception(e)
-				if error_count >= MAX_ERRORS_BEFORE_ALERT:
-					utils.send_error_notification(
-						'Main Loop Critical Error',
-						error_msg,
-						'CRITICAL'
-					)
-					error_count = 0
-				session = None  # Попробуем пересоздать сессию в следующей итерации
-			try:
-				sleep(60 * 60)
-			except KeyboardInterrupt:
-				logger.info('Application interrupted by user')
-				break
+		# Вне рабочего окна задачи не запускаются: планировщик спит до его начала
+		jobs = scheduler.Scheduler(WORK_START, WORK_END, on_error=on_job_error, on_success=on_job_success)
+		jobs.add(scheduler.Job('session', SESSION_INTERVAL, session_job))
+		scan = jobs.add(scheduler.Job('scan', SCAN_INTERVAL, scan_job))
+		jobs.add(scheduler.Job('blacklist', BLACKLIST_INTERVAL, blacklist_job))
+		# Полная проверка переживает перезапуск: считаем от последней выполненной
+		last_full_scan = float(db.get_meta('last_full_scan', 0))
+		if last_full_scan:
+			scan.next_run = datetime.fromtimestamp(last_full_scan) + SCAN_INTERVAL
+
+		try:
+			jobs.run_forever()
+		except KeyboardInterrupt:
+			logger.info('Application interrupted by user')
+		if commands is not None:
+			commands.stop()
+		stop_delivery()
+		firebird_pool.pool.close_all()
 	except Exception as e:
 		error_msg = f'Critical application error: {str(e)}'
 		logger.exception(error_msg)
@@ -485,3 +803,8 @@ if __name__ == '__main__':
 			error_msg,
 			'CRITICAL'
 		)
+	finally:
+		# Дожидаемся отправки накопленных уведомлений об ошибках
+		utils.error_reporter.stop()
+		recorder.recorder.close()
+		logger.complete()
@@ -0,0 +1,193 @@
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import monotonic, time
+from urllib.parse import urlsplit
+
+import sentry_sdk
+from loguru import logger
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))				# Порт HTTP /metrics (0 - не запускать)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')			# Адрес HTTP /metrics
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def label_key(labels):
+	return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(key, extra=()):
+	pairs = list(key) + list(extra)
+	if not pairs:
+		return ''
+	escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in pairs)
+	return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+	"""Метрика с метками; значения хранятся по набору меток"""
+	type = None
+
+	def __init__(self, name, help):
+		self.name = name
+		self.help = help
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def render(self):
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+		with self.lock:
+			for key, value in sorted(self.values.items()):
+				lines.append(f'{self.name}{format_labels(key)} {format_value(value)}')
+		return lines
+
+	def get(self, **labels):
+		with self.lock:
+			return self.values.get(label_key(labels), 0)
+
+
+class Counter(Metric):
+	type = 'counter'
+
+	def inc(self, amount=1, **labels):
+		key = label_key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+	type = 'gauge'
+
+	def set(self, value, **labels):
+		with self.lock:
+			self.values[label_key(labels)] = value
+
+
+class Histogram(Metric):
+	type = 'histogram'
+
+	def __init__(self, name, help, buckets=DURATION_BUCKETS):
+		super().__init__(name, help)
+		self.buckets = tuple(buckets)
+
+	def observe(self, value, **labels):
+		key = label_key(labels)
+		with self.lock:
+			counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+			counts[bisect_left(self.buckets, value)] += 1
+			self.values[key] = (counts, total + value)
+
+	def get(self, **labels):
+		"""(число наблюдений, сумма)"""
+		with self.lock:
+			counts, total = self.values.get(label_key(labels), ((), 0.0))
+			return sum(counts), total
+
+	def render(self):
+		lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+		with self.lock:
+			for key, (counts, total) in sorted(self.values.items()):
+				cumulative = 0
+				for bound, count in zip(self.buckets + ('+Inf',), counts):
+					cumulative += count
+					lines.append(f'{self.name}_bucket{format_labels(key, [("le", str(bound))])} {cumulative}')
+				lines.append(f'{self.name}_sum{format_labels(key)} {format_value(total)}')
+				lines.append(f'{self.name}_count{format_labels(key)} {cumulative}')
+		return lines
+
+
+class Registry:
+	def __init__(self):
+		self.metrics = []
+
+	def add(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def render(self):
+		"""Все метрики в текстовом формате Prometheus"""
+		lines = []
+		for metric in self.metrics:
+			lines.extend(metric.render())
+		return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# ===== МЕТРИКИ ЦИКЛА =====
+STAGE_SECONDS = registry.add(Histogram('wd_stage_duration_seconds', 'Duration of check cycle stages'))
+CYCLES = registry.add(Counter('wd_cycles_total', 'Check cycles run'))
+LAST_CYCLE = registry.add(Gauge('wd_last_cycle_timestamp_seconds', 'Unix time the last check cycle finished'))
+BLACKLIST_ENTRIES = registry.add(Gauge('wd_blacklist_entries', 'Entries in the last downloaded blacklist'))
+FLEET_ROWS = registry.add(Gauge('wd_fleet_rows', 'Cars in the last fleet fetch'))
+FLEET_ROWS_FETCHED = registry.add(Counter('wd_fleet_rows_fetched_total', 'Cars fetched from taxi databases'))
+HITS = registry.add(Counter('wd_hits_total', 'New blacklisted cars found in fleets'))
+DEDUP_SKIPS = registry.add(Counter('wd_dedup_skips_total', 'Blacklisted cars found in fleets but already reported'))
+NEAR_MISSES = registry.add(Counter('wd_near_misses_total', 'New possible matches (one typo away) found in fleets'))
+PHONE_MATCHES = registry.add(Counter('wd_phone_matches_total', 'New cars of blacklisted drivers found by phone'))
+SHARED_DRIVERS = registry.add(Counter('wd_shared_drivers_total', 'New drivers found working for several taxis'))
+POLICE_CACHE = registry.add(Counter('wd_police_cache_total', 'baza-gai.com.ua cache lookups'))
+MESSAGES_SENT = registry.add(Counter('wd_messages_sent_total', 'Telegram notifications delivered'))
+MESSAGE_FAILURES = registry.add(Counter('wd_message_failures_total', 'Failed Telegram send attempts'))
+HTTP_SECONDS = registry.add(Histogram('wd_http_request_duration_seconds', 'Outgoing HTTP request latency'))
+
+
+def observe_request(url, status, seconds):
+	"""Время HTTP запроса по хосту и статусу (status=None - сетевая ошибка)"""
+	HTTP_SECONDS.observe(seconds, host=urlsplit(url).hostname or '', status=status if status is not None else 'error')
+
+
+@contextmanager
+def stage(name, **labels):
+	"""Время этапа в wd_stage_duration_seconds и span в Sentry, если идёт транзакция"""
+	span = sentry_sdk.start_span(op=name) if sentry_sdk.get_current_span() is not None else nullcontext()
+	started = monotonic()
+	try:
+		with span:
+			yield
+	finally:
+		STAGE_SECONDS.observe(monotonic() - started, stage=name, **labels)
+
+
+@contextmanager
+def cycle(full_scan=False):
+	"""Цикл проверки целиком: этап cycle / full_scan и транзакция Sentry"""
+	name = 'full_scan' if full_scan else 'cycle'
+	transaction = sentry_sdk.start_transaction(op='cycle', name=name) if sentry_sdk.get_client().is_active() else nullcontext()
+	with transaction, stage(name):
+		yield
+	CYCLES.inc(kind=name)
+	LAST_CYCLE.set(time())
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		if self.path.split('?')[0] != '/metrics':
+			self.send_error(404)
+			return
+		body = registry.render().encode()
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+def start_server(port=METRICS_PORT, host=METRICS_HOST):
+	"""Запускает HTTP /metrics в фоновом потоке; None, если порт не задан"""
+	if not port:
+		return None
+	server = ThreadingHTTPServer((host, port), MetricsHandler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+	logger.info(f'Metrics available at http://{host}:{server.server_address[1]}/metrics')
+	return server
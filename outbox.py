@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+from time import monotonic
+
+from loguru import logger
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+
+# ===== ЛИМИТЫ TELEGRAM =====
+TELEGRAM_CHAT_INTERVAL = float(os.getenv('TELEGRAM_CHAT_INTERVAL', '3'))		# Пауза между сообщениями в один чат, сек (группы: 20/мин)
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '25'))			# Максимум сообщений в секунду на бота (лимит 30/сек)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '10'))				# Попыток отправки до отказа
+OUTBOX_RETRY_BASE = 5															# Первая пауза повтора при ошибке, сек
+OUTBOX_RETRY_MAX = 15 * 60														# Максимальная пауза повтора, сек
+OUTBOX_IDLE_WAIT = 60															# Проверка очереди без новых сообщений, сек
+OUTBOX_BATCH = 500																# Сообщений, читаемых из очереди за один проход
+
+
+def get_retry_after(error):
+	"""Возвращает retry_after из ответа 429 Telegram или None"""
+	if isinstance(error, ApiTelegramException) and error.error_code == 429:
+		parameters = error.result_json.get('parameters') or {}
+		return float(parameters.get('retry_after', TELEGRAM_CHAT_INTERVAL))
+	return None
+
+
+class OutboxState:
+	"""Лимиты и обработка результатов отправки, общие для потоковой и asyncio рассылки"""
+
+	def __init__(self, db, on_error=None):
+		self.db = db
+		self.on_error = on_error
+		self.chat_ready_at = {}				# chat_id -> monotonic, когда можно писать снова
+		self.global_ready_at = 0.0
+
+	def chat_delay(self, chat_id):
+		"""Сколько секунд ещё нельзя писать в чат"""
+		return max(self.chat_ready_at.get(chat_id, 0.0) - monotonic(), 0.0)
+
+	def reserve_global(self):
+		"""Резервирует место в общем темпе отправки; возвращает паузу перед отправкой"""
+		now = monotonic()
+		send_at = max(now, self.global_ready_at)
+		self.global_ready_at = send_at + 1.0 / TELEGRAM_GLOBAL_RATE
+		return send_at - now
+
+	def next_delay(self, delay, batch_full=False):
+		"""Пауза до следующей проверки очереди.
+
+		delay - ближайшее освобождение чата, сообщения в который уже пора
+		отправить. Наступившие сообщения сами по себе очередь не будят, иначе
+		пока чат выдерживает паузу, очередь перечитывалась бы в темпе TELEGRAM_GLOBAL_RATE.
+		Новые сообщения будят рассылку через notify().
+		"""
+		if batch_full:
+			# В очереди могут остаться непрочитанные наступившие сообщения
+			delay = 0
+		else:
+			next_attempt_at = self.db.get_next_attempt_time()
+			if next_attempt_at is not None:
+				delay = min(delay, max(next_attempt_at - time.time(), 0))
+		return max(delay, 1.0 / TELEGRAM_GLOBAL_RATE)
+
+	def on_success(self, message_id, chat_id):
+		self.chat_ready_at[chat_id] = monotonic() + TELEGRAM_CHAT_INTERVAL
+		self.db.delete_message(message_id)
+		metrics.MESSAGES_SENT.inc()
+		logger.debug(f'Message {message_id} delivered to chat {chat_id}')
+
+	def on_failure(self, message_id, chat_id, text, attempts, error, retry_after=None):
+		attempts += 1
+		metrics.MESSAGE_FAILURES.inc(reason='rate_limit' if retry_after is not None else 'error')
+		if retry_after is not None:
+			# 429 - ждём сколько просит Telegram, попытка не считается
+			logger.warning(f'Telegram rate limit for chat {chat_id}, retry after {retry_after:.0f}s')
+			self.chat_ready_at[chat_id] = monotonic() + retry_after
+			self.db.reschedule_message(message_id, time.time() + retry_after, attempts - 1)
+			return
+		if attempts >= OUTBOX_MAX_ATTEMPTS:
+			logger.error(f'Dropping message {message_id} to chat {chat_id} after {attempts} attempts: {error}\n{text}')
+			self.db.delete_message(message_id)
+			if self.on_error:
+				self.on_error('Telegram Message Dropped', f'Message to chat {chat_id} dropped after {attempts} attempts: {error}', 'ERROR')
+			return
+		wait_time = min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+		logger.warning(f'Failed to send message {message_id} to chat {chat_id} (attempt {attempts}), retry in {wait_time}s: {error}')
+		self.db.reschedule_message(message_id, time.time() + wait_time, attempts)
+
+
+class OutboxDispatcher(OutboxState, threading.Thread):
+	"""Фоновая рассылка уведомлений из таблицы outbox.
+
+	Сообщения хранятся в SQLite и переживают перезапуск. Между сообщениями в
+	один чат выдерживается TELEGRAM_CHAT_INTERVAL, общий темп ограничен
+	TELEGRAM_GLOBAL_RATE, а на 429 отправка в чат откладывается на retry_after.
+	"""
+
+	def __init__(self, db, bot, on_error=None):
+		OutboxState.__init__(self, db, on_error)
+		threading.Thread.__init__(self, name='outbox', daemon=True)
+		self.bot = bot
+		self.wakeup = threading.Event()
+		self.stopped = threading.Event()
+
+	def notify(self):
+		"""Будит поток после постановки нового сообщения в очередь"""
+		self.wakeup.set()
+
+	def stop(self):
+		self.stopped.set()
+		self.wakeup.set()
+
+	def run(self):
+		logger.info('Outbox dispatcher started')
+		while not self.stopped.is_set():
+			try:
+				self.wakeup.clear()
+				delay = self.dispatch()
+			except Exception as EX:
+				logger.exception(f'Outbox dispatcher error: {EX}')
+				delay = OUTBOX_RETRY_BASE
+			self.wakeup.wait(delay)
+
+	def dispatch(self):
+		"""Отправляет всё, что можно отправить сейчас; возвращает паузу до следующей проверки"""
+		delay = OUTBOX_IDLE_WAIT
+		messages = self.db.get_due_messages(OUTBOX_BATCH)
+		for message_id, chat_id, text, attempts in messages:
+			if self.stopped.is_set():
+				break
+			chat_delay = self.chat_delay(chat_id)
+			if chat_delay > 0:
+				delay = min(delay, chat_delay)
+				continue
+			time.sleep(self.reserve_global())
+			self.send(message_id, chat_id, text, attempts)
+		return self.next_delay(delay, len(messages) >= OUTBOX_BATCH)
+
+	def send(self, message_id, chat_id, text, attempts):
+		url = apihelper.API_URL or 'https://api.telegram.org/'
+		started = monotonic()
+		try:
+			self.bot.send_message(chat_id, text)
+		except Exception as EX:
+			metrics.observe_request(url, EX.error_code if isinstance(EX, ApiTelegramException) else None, monotonic() - started)
+			self.on_failure(message_id, chat_id, text, attempts, EX, get_retry_after(EX))
+			return
+		metrics.observe_request(url, 200, monotonic() - started)
+		self.on_success(message_id, chat_id)
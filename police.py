@@ -1,7 +1,15 @@
+import os
 import requests
 import json
+import threading
+from time import time
 from bs4 import BeautifulSoup
 import re
+from loguru import logger
+import utils
+import fleet
+import metrics
+import recorder
 # from conect_to_db import mysql_select, mysql_insert, mysql_update
 
 # def change_police_status(car_number, descr_of_the_police_site, year):                                                                  # Обновление статуса в бд(добавлено - 1 /удалено - 0 на соз)
@@ -11,13 +19,72 @@ import re
 #     mysql_update(SQL) 
 
 
-# Функция проверки года авто на сайте полиции
-def check_in_police(CarNumber):
-	data = {'digits': CarNumber}
-	response = requests.get('https://baza-gai.com.ua/search?', data=data)
-	result = response.text 																# Текст результата запроса
+POLICE_URL = os.getenv('POLICE_URL', 'https://baza-gai.com.ua/search?')				# Поиск по номеру
+POLICE_TIMEOUT = float(os.getenv('POLICE_TIMEOUT', '15'))								# Таймаут запроса, сек
+POLICE_CACHE_TTL_HOURS = float(os.getenv('POLICE_CACHE_TTL_HOURS', '168'))			# Срок жизни найденных данных, часы
+POLICE_NEGATIVE_TTL_HOURS = float(os.getenv('POLICE_NEGATIVE_TTL_HOURS', '24'))		# Срок жизни ответа "нет данных", часы
+
+cache_db = None																			# database.Database для кэша (см. init_cache)
+cache_stats = {'hits': 0, 'misses': 0}
+stats_lock = threading.Lock()
+
+
+def init_cache(db):
+	"""Включает кэш ответов baza-gai в SQLite"""
+	global cache_db
+	cache_db = db
+
+
+def normalize_plate(CarNumber):
+	"""Ключ кэша и запроса: канонический номер (латиница, без пробелов)"""
+	return fleet.normalize_plate(CarNumber)
+
+
+def count(stat):
+	with stats_lock:
+		cache_stats[stat] += 1
+	metrics.POLICE_CACHE.inc(result=stat)
+
+
+def get_cache_stats():
+	with stats_lock:
+		return dict(cache_stats)
+
+
+def is_fresh(data, fetched_at):
+	ttl_hours = POLICE_CACHE_TTL_HOURS if data else POLICE_NEGATIVE_TTL_HOURS
+	return time() - fetched_at < ttl_hours * 3600
+
+
+def lookup_cache(plate):
+	"""(True, data) для свежей записи кэша, иначе (False, None); учитывает счётчики"""
+	if cache_db is not None:
+		cached = cache_db.get_police_cache(plate)
+		if cached is not None and is_fresh(*cached):
+			count('hits')
+			return True, cached[0]
+	count('misses')
+	return False, None
+
+
+def lookup_cache_many(plates):
+	"""{номер: data} для номеров со свежей записью в кэше (одним запросом); учитывает попадания"""
+	if cache_db is None:
+		return {}
+	found = {plate: data for plate, (data, fetched_at) in cache_db.get_police_cache_many(plates).items() if is_fresh(data, fetched_at)}
+	for _ in found:
+		count('hits')
+	return found
+
+
+def store_cache(plate, data):
+	if cache_db is not None:
+		cache_db.set_police_cache(plate, data)
+
+
+# Разбор ответа сайта полиции
+def parse_police_page(result):
 	soup = BeautifulSoup(result, 'html.parser')											# Парсим результат через BeautifulSoup 
-	z = soup.prettify()																	# хз,надо
 	e = soup.find_all('small')															# Берём то,что находится между тегами small
 	data = re.findall('связан с.*<', str(e))											# Получаем год
 	year = re.findall(' \d{4}\D{1}', str(data))											# ОЧищаем от мусора
@@ -30,17 +97,52 @@ def check_in_police(CarNumber):
 		data = data.replace('связан с ', '')
 		data = data.replace('(', '')
 		data = data.replace(')', '')
-#		print(str(data[9:]) + ' ' + str(year) ------ str(CarNumber) - str(description))
-#		print(data)
-		# print(CarNumber)
+		return data
+	except IndexError:
+		return None
 
 
+# Функция проверки года авто на сайте полиции
+@recorder.capture('police', lambda CarNumber: normalize_plate(CarNumber))
+def check_in_police(CarNumber):
+	"""Данные baza-gai.com.ua по номеру с кэшем в SQLite.
+
+	Ответ "нет данных" тоже кэшируется (на POLICE_NEGATIVE_TTL_HOURS), а
+	сетевые ошибки - нет. При ошибке возвращается None.
+	"""
+	plate = normalize_plate(CarNumber)
+	cached, data = lookup_cache(plate)
+	if cached:
 		return data
 
-#			print('младше 15 лет' + str(year))
-	except IndexError:
+	# make_request соблюдает лимит запросов к baza-gai.com.ua из RATE_LIMITS
+	response = utils.make_request('GET', POLICE_URL, data={'digits': plate}, timeout=POLICE_TIMEOUT)
+	if response is None or response.status_code >= 400:
+		logger.warning(f'baza-gai.com.ua lookup failed for {plate}: {response.status_code if response is not None else "no response"}')
 		return None
 
+	return store_page(plate, response.text)
+
+
+def store_page(plate, html):
+	"""Разбирает ответ сайта и кэширует результат"""
+	data = parse_police_page(html)
+	store_cache(plate, data)
+	return data
+
+
+def check_many(CarNumbers):
+	"""Данные baza-gai.com.ua для пачки номеров: {номер: данные или None}.
+
+	Кэш проверяется одним запросом на всю пачку, на сайт через check_in_police
+	уходят только номера без свежей записи.
+	"""
+	plates = {CarNumber: normalize_plate(CarNumber) for CarNumber in CarNumbers}
+	found = lookup_cache_many(set(plates.values()))
+	for plate in set(plates.values()) - found.keys():
+		found[plate] = check_in_police(plate)
+	return {CarNumber: found[plate] for CarNumber, plate in plates.items()}
+
 
 def work_with_number(car_number):
 	result = check_in_police(car_number)
@@ -0,0 +1,190 @@
+import base64
+import functools
+import gzip
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, date
+from decimal import Decimal
+from time import sleep, monotonic
+
+from loguru import logger
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# ===== ЗАПИСЬ / ВОСПРОИЗВЕДЕНИЕ =====
+RECORD_MODE = os.getenv('RECORD_MODE', '').lower()							# '' | record | replay
+RECORD_DIR = os.getenv('RECORD_DIR', 'fixtures')							# Каталог с записями
+RECORD_SESSION = os.getenv('RECORD_SESSION', '')							# Запись для replay (по умолчанию - последняя)
+REPLAY_LATENCY_SCALE = float(os.getenv('REPLAY_LATENCY_SCALE', '1'))		# Множитель задержек при replay (0 - без задержек)
+
+
+def encode_value(value):
+	"""Значения из Firebird, которых нет в JSON"""
+	if isinstance(value, datetime):
+		return {'__datetime__': value.isoformat()}
+	if isinstance(value, date):
+		return {'__date__': value.isoformat()}
+	if isinstance(value, Decimal):
+		return {'__decimal__': str(value)}
+	if isinstance(value, bytes):
+		return {'__bytes__': base64.b64encode(value).decode()}
+	raise TypeError(f'Cannot record value of type {type(value).__name__}')
+
+
+def decode_value(obj):
+	if '__datetime__' in obj:
+		return datetime.fromisoformat(obj['__datetime__'])
+	if '__date__' in obj:
+		return date.fromisoformat(obj['__date__'])
+	if '__decimal__' in obj:
+		return Decimal(obj['__decimal__'])
+	if '__bytes__' in obj:
+		return base64.b64decode(obj['__bytes__'])
+	return obj
+
+
+def request_key(method, url, *args, **kwargs):
+	"""Ключ HTTP-запроса; параметры хэшируются, чтобы пароль логина не попал в файл"""
+	params = {name: kwargs.get(name) for name in ('params', 'data', 'json') if kwargs.get(name)}
+	digest = hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()[:16]
+	return f'{method.upper()} {url} {digest}'
+
+
+def encode_response(response):
+	if response is None:
+		return None
+	return {
+		'status': response.status_code,
+		'url': response.url,
+		'headers': {name: value for name, value in response.headers.items() if name.lower() in ('content-type', 'location')},
+		'body': base64.b64encode(response.content).decode(),		# Для stream=True читает ответ целиком
+	}
+
+
+def decode_response(data):
+	if data is None:
+		return None
+	response = Response()
+	response.status_code = data['status']
+	response.url = data['url']
+	response.headers = CaseInsensitiveDict(data['headers'])
+	response._content = base64.b64decode(data['body'])
+	response._content_consumed = True
+	response.encoding = get_encoding_from_headers(response.headers)
+	return response
+
+
+class Recorder:
+	"""Файлы записи: <RECORD_DIR>/<время начала>/<вид>.jsonl.gz.
+
+	Каждая строка - {'key', 'time', 'latency', 'result'}. При воспроизведении
+	результаты по одному ключу отдаются в порядке записи, последний
+	повторяется, если запросов больше, чем было записано.
+	"""
+
+	def __init__(self, mode=RECORD_MODE, directory=RECORD_DIR, session=RECORD_SESSION, latency_scale=REPLAY_LATENCY_SCALE):
+		self.mode = mode
+		self.directory = directory
+		self.session = session
+		self.latency_scale = latency_scale
+		self.files = {}
+		self.recorded = {}						# вид -> {ключ: [записи]}
+		self.positions = {}						# (вид, ключ) -> номер следующей записи
+		self.lock = threading.Lock()
+		self.active = threading.local()			# Вложенные вызовы (make_request внутри check_in_police) не пишем дважды
+
+	def session_dir(self):
+		if not self.session:
+			if self.mode == 'record':
+				self.session = datetime.now().strftime('%Y%m%d-%H%M%S')
+			else:
+				sessions = sorted(os.listdir(self.directory)) if os.path.isdir(self.directory) else []
+				if not sessions:
+					raise FileNotFoundError(f'No recordings in {self.directory}')
+				self.session = sessions[-1]
+		return os.path.join(self.directory, self.session)
+
+	def write(self, kind, key, latency, result):
+		line = json.dumps(
+			{'key': key, 'time': datetime.now().isoformat(), 'latency': round(latency, 4), 'result': result},
+			ensure_ascii=False, default=encode_value,
+		)
+		with self.lock:
+			file = self.files.get(kind)
+			if file is None:
+				path = self.session_dir()
+				os.makedirs(path, exist_ok=True)
+				file = self.files[kind] = gzip.open(os.path.join(path, f'{kind}.jsonl.gz'), 'at', encoding='utf-8')
+				logger.info(f'Recording {kind} to {path}')
+			file.write(line + '\n')
+			file.flush()
+
+	def load(self, kind):
+		path = os.path.join(self.session_dir(), f'{kind}.jsonl.gz')
+		entries = {}
+		if os.path.exists(path):
+			with gzip.open(path, 'rt', encoding='utf-8') as file:
+				for line in file:
+					entry = json.loads(line, object_hook=decode_value)
+					entries.setdefault(entry['key'], []).append(entry)
+		logger.info(f'Replaying {sum(map(len, entries.values()))} {kind} entries from {path}')
+		return entries
+
+	def read(self, kind, key):
+		"""(найдено, latency, result)"""
+		with self.lock:
+			if kind not in self.recorded:
+				self.recorded[kind] = self.load(kind)
+			entries = self.recorded[kind].get(key)
+			if not entries:
+				return False, 0.0, None
+			position = self.positions.get((kind, key), 0)
+			self.positions[(kind, key)] = position + 1
+			entry = entries[min(position, len(entries) - 1)]
+		return True, entry['latency'], entry['result']
+
+	def close(self):
+		with self.lock:
+			for file in self.files.values():
+				file.close()
+			self.files.clear()
+
+
+recorder = Recorder()
+
+
+def capture(kind, key, encode=lambda result: result, decode=lambda result: result):
+	"""Декоратор записи/воспроизведения вызовов функции.
+
+	key(*args, **kwargs) - ключ вызова, encode/decode переводят результат в
+	JSON и обратно. В режиме replay функция не вызывается: результат берётся
+	из записи (с исходной задержкой, умноженной на REPLAY_LATENCY_SCALE), а
+	вызов без записи возвращает None, как при ошибке.
+	"""
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			if not recorder.mode or getattr(recorder.active, 'depth', 0):
+				return func(*args, **kwargs)
+			call_key = key(*args, **kwargs)
+			if recorder.mode == 'replay':
+				found, latency, result = recorder.read(kind, call_key)
+				if not found:
+					logger.warning(f'No recorded {kind} for {call_key}')
+					return None
+				if recorder.latency_scale:
+					sleep(latency * recorder.latency_scale)
+				return decode(result)
+			recorder.active.depth = 1
+			started = monotonic()
+			try:
+				result = func(*args, **kwargs)
+			finally:
+				recorder.active.depth = 0
+			recorder.write(kind, call_key, monotonic() - started, encode(result))
+			return result
+		return wrapper
+	return decorator
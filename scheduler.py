@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta, time
+from time import sleep
+
+from loguru import logger
+
+
+def parse_time(value):
+	"""'09:10' -> time(9, 10)"""
+	hours, minutes = value.split(':')
+	return time(int(hours), int(minutes))
+
+
+class Job:
+	"""Периодическая задача планировщика"""
+
+	def __init__(self, name, interval, func, work_hours_only=True):
+		self.name = name
+		self.interval = interval				# timedelta между запусками
+		self.func = func
+		self.work_hours_only = work_hours_only
+		self.next_run = datetime.min			# Первый запуск - сразу (в рабочее время)
+
+	def __repr__(self):
+		return f'<Job {self.name} next={self.next_run:%Y-%m-%d %H:%M:%S}>'
+
+
+class Scheduler:
+	"""Планировщик задач с рабочим окном.
+
+	Для каждой задачи хранится время следующего запуска; между запусками
+	планировщик спит ровно до ближайшего из них. Задачи с work_hours_only
+	вне окна [work_start, work_end) переносятся на начало следующего окна.
+	"""
+
+	def __init__(self, work_start, work_end, on_error=None, on_success=None):
+		self.work_start = work_start
+		self.work_end = work_end
+		self.on_error = on_error				# (job, error) после неудачного запуска
+		self.on_success = on_success			# (job) после успешного запуска
+		self.jobs = {}
+
+	def add(self, job):
+		self.jobs[job.name] = job
+		return job
+
+	def in_work_window(self, moment):
+		return self.work_start <= moment.time() < self.work_end
+
+	def next_window_start(self, moment):
+		start = datetime.combine(moment.date(), self.work_start)
+		if moment.time() >= self.work_start:
+			start += timedelta(days=1)
+		return start
+
+	def due_time(self, job, now):
+		"""Когда задача реально запустится с учётом рабочего окна"""
+		due = max(job.next_run, now)
+		if job.work_hours_only and not self.in_work_window(due):
+			return self.next_window_start(due)
+		return due
+
+	def trigger(self, name):
+		"""Запустить задачу при ближайшей возможности"""
+		self.jobs[name].next_run = datetime.now()
+
+	def postpone(self, name, delay=None):
+		"""Перенести задачу на delay (по умолчанию - на её интервал) от текущего момента"""
+		job = self.jobs[name]
+		job.next_run = datetime.now() + (delay if delay is not None else job.interval)
+
+	def run_pending(self):
+		"""Выполняет все задачи, время которых наступило, в порядке добавления"""
+		for job in list(self.jobs.values()):
+			now = datetime.now()
+			if self.due_time(job, now) > now:
+				continue
+			job.next_run = now + job.interval
+			logger.debug(f'Running job {job.name}')
+			try:
+				job.func()
+			except Exception as EX:
+				logger.exception(f'Job {job.name} failed: {EX}')
+				if self.on_error:
+					self.on_error(job, EX)
+				continue
+			if self.on_success:
+				self.on_success(job)
+
+	def seconds_until_next(self):
+		now = datetime.now()
+		next_due = min(self.due_time(job, now) for job in self.jobs.values())
+		return max((next_due - now).total_seconds(), 0.0)
+
+	def run_forever(self):
+		while True:
+			self.run_pending()
+			delay = self.seconds_until_next()
+			if delay > 0:
+				logger.info(f'Next job in {timedelta(seconds=round(delay))}: {self.next_jobs()}')
+				sleep(delay)
+
+	def next_jobs(self):
+		now = datetime.now()
+		return ', '.join(
+			f'{job.name} at {self.due_time(job, now):%H:%M}'
+			for job in sorted(self.jobs.values(), key=lambda job: self.due_time(job, now))
+		)